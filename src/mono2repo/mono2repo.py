@@ -6,15 +6,33 @@ Example:
         https://github.com/cav71/pelican.git/pelican/themes/notmyidea
 """
 import argparse
+import collections
 import contextlib
+import datetime
+import fnmatch
+import functools
+import hashlib
+import importlib
+import json
 import logging
 import os
 import pathlib
 import platform
 import re
+import shlex
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+
+if sys.platform != "win32":
+    import fcntl
+
+# asyncio and concurrent.futures are imported by the functions using them
+# (update-all, extract-many and the refs): they take longer to import than
+# all the modules above, eg. for --help or --version
 
 __version__ = ""
 __hash__ = ""
@@ -36,34 +54,228 @@ class InvalidGitDir(Mono2RepoError):
 
 
 def which(exe):
-    cmd = {
-        "linux": "which",
-        "darwin": "which",
-        "unix": "which",
-        "windows": "where",
-    }[platform.uname().system.lower()]
-    return subprocess.check_output([cmd, exe], encoding="utf-8").strip()
+    path = shutil.which(exe)
+    if not path:
+        raise FileNotFoundError("cannot find executable", exe)
+    return path
+
+
+def cache_home():
+    """the mono2repo user cache dir (eg. ~/.cache/mono2repo)"""
+    base = os.getenv("XDG_CACHE_HOME")
+    system = platform.uname().system.lower()
+    if not base and system == "windows":
+        base = os.getenv("LOCALAPPDATA") or pathlib.Path.home() / "AppData/Local"
+    elif not base and system == "darwin":
+        base = pathlib.Path.home() / "Library/Caches"
+    return pathlib.Path(base or pathlib.Path.home() / ".cache") / "mono2repo"
+
+
+class Capabilities:
+    """the git and filter-repo versions, probed once per executable
+
+    The probes (eg. git filter-repo --version, a python start of its own)
+    are kept in <cache_home>/capabilities.json keyed by the executables
+    path and mtime (symlinks resolved), so they run again only when a binary
+    changes (a failed probe isn't cached). A shim picking its target when
+    run (eg. pyenv) is keyed by itself, not by the target.
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path or cache_home() / "capabilities.json")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} path={self.path} at {hex(id(self))}>"
+
+    @staticmethod
+    def stamp(*exes):
+        result = []
+        for exe in exes:
+            path = shutil.which(exe)
+            with contextlib.suppress(OSError, TypeError):
+                path = os.path.realpath(path)
+                result.append(f"{path}:{os.stat(path).st_mtime_ns}")
+                continue
+            result.append(str(path))
+        return " ".join(result)
+
+    def load(self):
+        with contextlib.suppress(OSError, ValueError):
+            return json.loads(self.path.read_text())
+        return {}
+
+    def save(self, data):
+        # a read-only cache dir only costs the probes
+        with contextlib.suppress(OSError):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(data, indent=2, sort_keys=True))
+            os.replace(tmp, self.path)
+
+    def probe(self, name, cmd, exes):
+        key = self.stamp(*exes)
+        data = self.load()
+        if data.get(name, {}).get("key") == key:
+            return data[name]["version"]
+        version = run(cmd, abort=False, silent=True)
+        if version:
+            data[name] = {"key": key, "version": version}
+            self.save(data)
+        return version
+
+    def git(self):
+        return self.probe("git", ["git", "--version"], ["git"])
+
+    def filter_repo(self):
+        # git looks up its plugins in its exec path, then in the PATH
+        exes = ["git", "git-filter-repo"]
+        exec_path = run(["git", "--exec-path"], abort=False, silent=True)
+        if exec_path:
+            exes.append(pathlib.Path(exec_path) / "git-filter-repo")
+        return self.probe("filter-repo", ["git", "filter-repo", "--version"], exes)
+
+
+class Profiler:
+    """collects wall time, exit code and output size of each subprocess
+
+    The commands are grouped under the (innermost) running phase:
+        with profiler.phase("clone"):
+            run(["git", "clone", uri, dst])
+        profiler.dump("out.json")
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        parent = self.stack[-1]["name"] if self.stack else None
+        entry = {"name": name, "parent": parent, "wall": None, "commands": []}
+        self.phases.append(entry)
+        self.stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry["wall"] = time.perf_counter() - start
+            self.stack.pop()
+
+    def record(self, cmd, wall, code, nbytes):
+        if self.stack:
+            entry = self.stack[-1]
+        else:
+            # commands outside any phase
+            if not (self.phases and self.phases[-1]["name"] == "other"):
+                self.phases.append(
+                    {"name": "other", "parent": None, "wall": 0.0, "commands": []}
+                )
+            entry = self.phases[-1]
+            entry["wall"] += wall
+        entry["commands"].append(
+            {
+                "cmd": [str(c) for c in cmd],
+                "wall": wall,
+                "code": code,
+                "bytes": nbytes,
+            }
+        )
+
+    def report(self):
+        return {
+            "version": __version__,
+            "argv": sys.argv,
+            "wall": time.perf_counter() - self.start,
+            "phases": self.phases,
+        }
+
+    def dump(self, path):
+        pathlib.Path(path).write_text(json.dumps(self.report(), indent=2))
+
+
+profiler = Profiler()
 
 
 def run(args, abort=True, silent=False, dryrun=False):
     cmd = [args] if isinstance(args, str) else args
     if dryrun:
         return [str(c) for c in cmd]
+    start, code, txt = time.perf_counter(), 0, ""
     try:
-        return subprocess.check_output(
+        txt = subprocess.check_output(
             [str(c) for c in cmd],
             encoding="utf-8",
             stderr=subprocess.DEVNULL if silent else None,
-        ).strip()
-    except Exception:
+        )
+        return txt.strip()
+    except Exception as exc:
+        code = getattr(exc, "returncode", None)
         if abort is True:
             raise
         elif abort:
             raise abort
+    finally:
+        wall = time.perf_counter() - start
+        profiler.record(cmd, wall, code, len(txt.encode("utf-8")))
+
+
+def run_lines(args, silent=False):
+    """like run, but yields the output lines while the command runs
+
+    Leaving the loop early (eg. break) terminates the command, so only
+    the lines consumed are ever read:
+        for line in run_lines(["git", "log", "--format=%H"]):
+            break
+    """
+    cmd = [args] if isinstance(args, str) else args
+    start, nbytes = time.perf_counter(), 0
+    process = subprocess.Popen(
+        [str(c) for c in cmd],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL if silent else None,
+        encoding="utf-8",
+    )
+    try:
+        for line in process.stdout:
+            nbytes += len(line)
+            yield line.rstrip("\n")
+    except GeneratorExit:
+        process.terminate()
+        raise
+    finally:
+        process.stdout.close()
+        code = process.wait()
+        profiler.record(cmd, time.perf_counter() - start, code, nbytes)
+    if code:
+        raise subprocess.CalledProcessError(code, cmd)
+
+
+def parse_size(txt):
+    """converts a size string (eg. 512M, 10G) into bytes"""
+    if txt is None or isinstance(txt, int):
+        return txt
+    match = re.search(r"^\s*(\d+(?:[.]\d+)?)\s*([kmgt]?)i?b?\s*$", str(txt).lower())
+    if not match:
+        raise ValueError("invalid size", txt)
+    scale = 1024 ** " kmgt".index(match.group(2) or " ")
+    return int(float(match.group(1)) * scale)
+
+
+def format_size(size):
+    """bytes as a size string (the inverse of parse_size, eg. 1.5M)"""
+    for unit in " KMGT":
+        if size < 1024 or unit == "T":
+            break
+        size /= 1024
+    return f"{size:.0f}" if unit == " " else f"{size:.1f}{unit}"
 
 
 def split_source(path):
-    if re.search("^(http|https|git|ssh):", str(path)) or str(path).startswith(
+    if re.search("^(http|https|git|ssh|file):", str(path)) or str(path).startswith(
         "git@github.com:"
     ):
         assert ".git" in str(path), f"no .git in path {path}"
@@ -77,6 +289,13 @@ def split_source(path):
     raise ValueError("invalid git uri", path)
 
 
+def join_source(source, subdir):
+    """the inverse of split_source"""
+    if isinstance(source, pathlib.Path):
+        return str(source / subdir) if subdir else str(source)
+    return f"{source}/{subdir}" if subdir else str(source)
+
+
 @contextlib.contextmanager
 def tempdir(tmpdir=None):
     path = tmpdir or pathlib.Path(tempfile.mkdtemp())
@@ -86,7 +305,8 @@ def tempdir(tmpdir=None):
     finally:
         if not tmpdir:
             log.debug("cleaning up tmpdir %s", path)
-            shutil.rmtree(path, ignore_errors=True)
+            with profiler.phase("cleanup"):
+                shutil.rmtree(path, ignore_errors=True)
         else:
             log.debug("leaving behind tmpdir %s", tmpdir)
 
@@ -104,18 +324,74 @@ class Git:
         raise InvalidGitDir("cannot find git root", path)
 
     @staticmethod
-    def clone(uri, dst):
+    def clone(
+        uri,
+        dst,
+        cache=None,
+        fetch=True,
+        bare=False,
+        blobless=False,
+        shared=False,
+        sparse=None,
+        shallow=(),
+    ):
+        """clones uri in dst
+
+        bare skips the checkout, blobless makes a partial clone with no
+        blobs (see prefetch) and shared borrows the objects of a local uri;
+        sparse (a subdir) checks out that subdir only (see sparse_args) and
+        shallow are the clone --shallow-* flags (the boundary commits get
+        their parents and the excluded refs are fetched, see shallow_args).
+        """
         if not dst.exists():
-            subprocess.check_call(["git", "clone", uri, dst])
+            with contextlib.ExitStack() as stack:
+                if cache:
+                    # local clone from the mirror (hardlinks the objects), the
+                    # other processes don't refresh nor evict it meanwhile
+                    uri = stack.enter_context(cache.use(uri, fetch=fetch)).worktree
+                args = Git.clone_args(uri, dst, bare, blobless, shared, bool(sparse))
+                run([*args[:2], *shallow, *args[2:]])
+            if shallow:
+                Git(dst).run(["fetch", "-q", "--deepen=1", "origin"])
+                for flag in shallow:
+                    name, _, ref = flag.partition("=")
+                    if name == "--shallow-exclude":
+                        Git(dst).run(["fetch", "-q", "origin", f"+{ref}:{ref}"])
+            if sparse:
+                Git(dst).run(Git.sparse_args(sparse))
         return Git(dst)
 
+    @staticmethod
+    def clone_args(uri, dst, bare=False, blobless=False, shared=False, sparse=False):
+        flags = ["--bare"] if bare else []
+        flags += ["--filter=blob:none"] if blobless else []
+        flags += ["--shared"] if shared else []
+        flags += ["--sparse"] if sparse else []
+        return ["git", "clone", *flags, uri, dst]
+
+    @staticmethod
+    def sparse_args(subdir):
+        # cone mode matches whole directories (no patterns) and the sparse
+        # index keeps the entries out of the cone collapsed into their trees
+        return ["sparse-checkout", "set", "--cone", "--sparse-index", subdir]
+
+    # commands moving HEAD (or creating the repo): they drop the cached state
+    MUTATING = {"am", "checkout", "init", "rebase", "reset", "switch"}
+
+    # the read-only queries backend (see READERS), auto picks the first
+    # library installed and it falls back to the git cli
+    READER = os.getenv("MONO2REPO_READER", "auto")
+
     def __init__(self, worktree=None):
         self.worktree = pathlib.Path(worktree or os.getcwd())
+        self.state = {}  # cached good/branch
+        self.reader = reader(self, self.READER)
 
     def __repr__(self):
         return (
             f"<{self.__class__.__name__} "
-            f"branch={self.branch or 'undef'} worktree={self.worktree} "
+            f"branch={self.state.get('branch') or 'undef'} "
+            f"worktree={self.worktree} "
             f"at {hex(id(self))}>"
         )
 
@@ -128,38 +404,1599 @@ class Git:
                 "-C",
                 self.worktree,
             ]
+        args = [args] if isinstance(args, str) else args
+        cmd.extend(args)
+        try:
+            return run(cmd, **kwargs)
+        finally:
+            if self.state and self.subcommand(args) in self.MUTATING:
+                self.state.clear()
+
+    @staticmethod
+    def subcommand(args):
+        """the git subcommand in args (eg. rebase for -c x=y rebase master)"""
+        args = iter(args)
+        for arg in args:
+            if arg == "-c":
+                next(args, None)
+            elif not str(arg).startswith("-"):
+                return str(arg)
+
+    def run_lines(self, args, **kwargs):
+        cmd = ["git", "-C", self.worktree]
         cmd.extend([args] if isinstance(args, str) else args)
-        return run(cmd, **kwargs)
+        return run_lines(cmd, **kwargs)
+
+    def session(self):
+        """a persistent cat-file session for the object lookups (see CatFile)"""
+        return CatFile(self)
 
     # commands
+    def gitpath(self, name):
+        """absolute path of name under the git dir (eg. objects)"""
+        return pathlib.Path(
+            self.run(["rev-parse", "--path-format=absolute", "--git-path", name])
+        )
+
+    def tree(self, path="", rev="HEAD"):
+        """the tree oid of path in rev (or None), no checkout needed"""
+        return self.run(
+            ["rev-parse", "--verify", "-q", f"{rev}:{path}"], abort=False, silent=True
+        )
+
+    def borrow(self, *objects):
+        """adds objects (other repos objects dirs) to the alternates"""
+        path = self.gitpath("objects/info/alternates")
+        lines = path.read_text().split("\n") if path.exists() else []
+        lines += [str(o) for o in objects if str(o) not in lines]
+        path.write_text("".join(f"{line}\n" for line in lines if line))
+
+    def size(self):
+        """the bytes of the objects (packed and loose)"""
+        counts = self.run(["count-objects", "-v"]).split("\n")
+        counts = dict(line.split(": ") for line in counts)
+        return (int(counts["size-pack"]) + int(counts["size"])) * 1024
+
+    def dissociate(self):
+        """copies the borrowed objects in and cuts the alternates link
+
+        The objects of an output attached to a store go in the store (see
+        ObjectStore.sync), which stays borrowed.
+        """
+        path = self.gitpath("objects/info/alternates")
+        if path.exists():
+            store = self.config("mono2repo.store", local=True)
+            if store:
+                ObjectStore(store).sync(self)
+                return
+            self.run(["repack", "-a", "-d", "-q"])
+            path.unlink()
+
     def good(self):
-        with contextlib.suppress(subprocess.CalledProcessError):
-            self.run(["status"], silent=True)
-            return True
+        if "good" not in self.state:
+            self.state["good"] = self.reader.good()
+        return self.state["good"]
 
     @property
     def branch(self):
-        if self.good():
-            return self.run(
-                [
-                    "branch",
-                    "--show-current",
-                ]
-            ).strip()
+        if "branch" not in self.state:
+            self.state["branch"] = self.reader.branch() if self.good() else None
+        return self.state["branch"]
 
     @branch.setter
     def branch(self, value):
         self.run(["checkout", value])
         return self.branch
 
-    def init(self, branch=None):
+    def config(self, key, local=False):
+        """the key config value (or None)"""
+        return self.reader.config(key, local)
+
+    def dirty(self):
+        """true if the worktree has changes (untracked files too)"""
+        return self.reader.dirty()
+
+    def init(self, branch=None, bare=False):
         if not self.worktree.exists():
             self.worktree.mkdir(parents=True, exist_ok=True)
-        self.run("init")
+        self.run(["init", "--bare"] if bare else "init")
         if branch:
             self.run(["checkout", "-b", branch], silent=True)
 
 
+# read-only queries
+def fallback(method):
+    """the library reader method falls back to the cli one on errors"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except Exception as exc:
+            log.debug("%s %s failed (%s), using git", self.name, method.__name__, exc)
+            return getattr(Reader, method.__name__)(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Reader:
+    """answers the read-only queries of a Git running the git cli
+
+    The library readers answer them in-process (no fork per query).
+    """
+
+    name = "cli"
+
+    def __init__(self, git):
+        self.git = git
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def good(self):
+        txt = self.git.run(["rev-parse", "--git-dir"], abort=False, silent=True)
+        return txt is not None
+
+    def branch(self):
+        return self.git.run(["branch", "--show-current"]).strip()
+
+    def config(self, key, local=False):
+        cmd = ["config", "--local", "--get", key] if local else ["config", "--get", key]
+        return self.git.run(cmd, abort=False, silent=True)
+
+    def dirty(self):
+        return bool(self.git.run(["status", "-s", "--porcelain"]).strip())
+
+    def first_date(self, pathspec=()):
+        return first_date(self.git, pathspec)
+
+
+def format_date(timestamp, offset):
+    """timestamp (offset minutes east of utc) as git log %cd"""
+    tz = datetime.timezone(datetime.timedelta(minutes=offset))
+    date = datetime.datetime.fromtimestamp(timestamp, tz)
+    day = "Mon Tue Wed Thu Fri Sat Sun".split()[date.weekday()]
+    month = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()[date.month - 1]
+    sign, offset = "-" if offset < 0 else "+", abs(offset)
+    return (
+        f"{day} {month} {date.day} {date:%H:%M:%S} {date.year} "
+        f"{sign}{offset // 60:02d}{offset % 60:02d}"
+    )
+
+
+class LibraryReader(Reader):
+    """a reader using the name python module (imported on first use)"""
+
+    module = None
+
+    @classmethod
+    def available(cls):
+        if cls.module is None:
+            try:
+                cls.module = importlib.import_module(cls.name)
+            except ImportError:
+                cls.module = False
+        return bool(cls.module)
+
+    def first_date(self, pathspec=()):
+        if pathspec:
+            # path limited walks are left to git
+            return super().first_date(pathspec)
+        roots = self.roots()
+        if not roots:
+            raise Mono2RepoError("no commits in", self.git)
+        # the oldest root, as the last root listed by rev-list
+        return format_date(*min(roots))
+
+
+class Pygit2Reader(LibraryReader):
+    name = "pygit2"
+
+    def open(self):
+        return self.module.Repository(str(self.git.worktree))
+
+    @fallback
+    def good(self):
+        return self.module.discover_repository(str(self.git.worktree)) is not None
+
+    @fallback
+    def branch(self):
+        target = self.open().references["HEAD"].target
+        if isinstance(target, str) and target.startswith("refs/heads/"):
+            return target[11:]
+        return ""
+
+    @fallback
+    def config(self, key, local=False):
+        repo = self.open()
+        config = repo.config
+        if local:
+            config = self.module.Config(os.path.join(repo.path, "config"))
+        return config[key] if key in config else None
+
+    @fallback
+    def dirty(self):
+        ignored = self.module.GIT_STATUS_IGNORED
+        return any(flags != ignored for flags in self.open().status().values())
+
+    @fallback
+    def roots(self):
+        repo = self.open()
+        if repo.head_is_unborn:
+            return []
+        return [
+            (commit.commit_time, commit.commit_time_offset)
+            for commit in repo.walk(repo.head.target)
+            if not commit.parent_ids
+        ]
+
+
+class DulwichReader(LibraryReader):
+    name = "dulwich"
+
+    def open(self):
+        return self.module.repo.Repo.discover(str(self.git.worktree))
+
+    @classmethod
+    def available(cls):
+        if super().available():
+            importlib.import_module("dulwich.porcelain")
+        return bool(cls.module)
+
+    @fallback
+    def good(self):
+        try:
+            self.open()
+        except self.module.errors.NotGitRepository:
+            return False
+        return True
+
+    @fallback
+    def branch(self):
+        target = self.open().refs.read_ref(b"HEAD")
+        if target and target.startswith(b"ref: refs/heads/"):
+            return target[16:].decode("utf-8")
+        return ""
+
+    @fallback
+    def config(self, key, local=False):
+        repo = self.open()
+        config = repo.get_config() if local else repo.get_config_stack()
+        section, name = key.encode("utf-8").rsplit(b".", 1)
+        section = tuple(section.split(b".", 1))
+        try:
+            return config.get(section, name).decode("utf-8")
+        except KeyError:
+            return None
+
+    @fallback
+    def dirty(self):
+        status = self.module.porcelain.status(self.open())
+        return bool(any(status.staged.values()) or status.unstaged or status.untracked)
+
+    @fallback
+    def roots(self):
+        repo = self.open()
+        if b"HEAD" not in repo.refs:
+            return []
+        return [
+            (entry.commit.commit_time, entry.commit.commit_timezone // 60)
+            for entry in repo.get_walker(include=[repo.head()])
+            if not entry.commit.parents
+        ]
+
+
+READERS = {reader.name: reader for reader in [Pygit2Reader, DulwichReader, Reader]}
+
+
+def reader(git, name="auto"):
+    """the name reader for git (auto: the first available), the git cli
+    one when the library isn't installed
+    """
+    names = list(READERS) if name == "auto" else [name]
+    for cls in [READERS[n] for n in names if n in READERS]:
+        if cls.available():
+            return cls(git)
+    if name != "auto":
+        log.debug("reader %s not available, using git", name)
+    return Reader(git)
+
+
+class MirrorCache:
+    """persistent cache of bare mirrors keyed by the source uri
+
+    Each mirror lives under <path>/<sha1 of uri>.git and it is refreshed
+    with an incremental fetch on use; when maxsize is set the least
+    recently used mirrors are evicted to keep the cache under the cap.
+    The mirrors are locked (flock on <sha1 of uri>.lock, not on windows):
+    exclusively while created, refreshed or evicted, shared while in use
+    (see use), so a mirror in use is never evicted.
+    """
+
+    STAMP = "mono2repo-last-used"
+
+    def __init__(self, path, maxsize=None):
+        self.path = pathlib.Path(path).expanduser().resolve()
+        self.maxsize = parse_size(maxsize)
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} path={self.path} "
+            f"maxsize={self.maxsize} at {hex(id(self))}>"
+        )
+
+    def key(self, uri):
+        return hashlib.sha1(str(uri).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def lock(path, shared=False, block=True):
+        # the lock file sits next to the mirror (created by a rename), it
+        # yields False when the mirror is locked already and not block
+        with open(path.with_suffix(".lock"), "a") as handle:
+            locked = True
+            if sys.platform != "win32":
+                flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+                try:
+                    fcntl.flock(handle, flags | (0 if block else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    locked = False
+            yield locked
+
+    def mirror(self, uri, fetch=True):
+        with self.use(uri, fetch) as git:
+            return git
+
+    @contextlib.contextmanager
+    def use(self, uri, fetch=True):
+        """yields the (created or refreshed) mirror of uri, in use
+
+        Creating and refreshing take an exclusive lock, using a shared one:
+        many processes use a mirror at the same time, none refreshes nor
+        evicts it meanwhile.
+        """
+        path = self.path / f"{self.key(uri)}.git"
+        self.path.mkdir(parents=True, exist_ok=True)
+        while True:
+            if fetch or not path.exists():
+                with self.lock(path):
+                    self.refresh(uri, path, fetch)
+            with self.lock(path, shared=True):
+                # evicted between the locks: created again
+                if path.exists():
+                    (path / self.STAMP).write_text(f"{time.time()}\n")
+                    self.evict(keep={path})
+                    yield Git(path)
+                    return
+
+    def refresh(self, uri, path, fetch=True):
+        # creates the path mirror of uri or refreshes it (with fetch)
+        if not path.exists():
+            log.debug("creating mirror for %s in %s", uri, path)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            shutil.rmtree(tmp, ignore_errors=True)
+            run(["git", "clone", "--bare", uri, tmp])
+            git = Git(tmp)
+            git.run(["config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"])
+            git.run(
+                ["config", "--add", "remote.origin.fetch", "+refs/tags/*:refs/tags/*"]
+            )
+            git.run(["config", "mono2repo.uri", str(uri)])
+            try:
+                tmp.rename(path)
+            except OSError:
+                # created meanwhile (by a process not locking), it's as good
+                log.debug("using the mirror %s created meanwhile", path)
+                shutil.rmtree(tmp, ignore_errors=True)
+        elif fetch:
+            log.debug("refreshing mirror for %s in %s", uri, path)
+            Git(path).run(["fetch", "--prune", "origin"])
+
+    def entries(self):
+        """returns the mirrors as (path, last-used, size) tuples, oldest first"""
+        result = []
+        for path in self.path.glob("*.git"):
+            # a mirror evicted meanwhile (by another process) is skipped
+            with contextlib.suppress(FileNotFoundError):
+                stamp = path / self.STAMP
+                used = stamp.stat().st_mtime if stamp.exists() else 0
+                size = sum(
+                    (pathlib.Path(root) / name).stat().st_size
+                    for root, _, names in os.walk(path)
+                    for name in names
+                )
+                result.append((path, used, size))
+        return sorted(result, key=lambda entry: entry[1])
+
+    def evict(self, keep=()):
+        if self.maxsize is None:
+            return []
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        evicted = []
+        for path, _, size in entries:
+            if total <= self.maxsize:
+                break
+            if path in keep:
+                continue
+            with self.lock(path, block=False) as locked:
+                if not locked:
+                    log.debug("not evicting mirror %s (in use)", path)
+                    continue
+                log.debug("evicting mirror %s (%i bytes)", path, size)
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted.append(path)
+        return evicted
+
+
+class FilterCache:
+    """persistent cache of filtered histories, as git bundles
+
+    The entries are keyed by the upstream commit, the subdir and the filter
+    options (see key): <path>/<key>.bundle, the upstream -> filtered commits
+    <key>.map and their <key>.sha256 checksum.
+    Entries older than maxage (seconds) or the least recently used above
+    maxsize are evicted.
+    """
+
+    def __init__(self, path, maxsize=None, maxage=None):
+        self.path = pathlib.Path(path).expanduser().resolve()
+        self.maxsize = parse_size(maxsize)
+        self.maxage = maxage
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} path={self.path} "
+            f"maxsize={self.maxsize} maxage={self.maxage} at {hex(id(self))}>"
+        )
+
+    def key(self, head, subdir, backend):
+        txt = f"{head}\n{subdir.strip('/')}\n{backend}\n"
+        return hashlib.sha1(txt.encode("utf-8")).hexdigest()
+
+    def checksum(self, *paths):
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def drop(self, key):
+        for ext in ["bundle", "map", "sha256"]:
+            (self.path / f"{key}.{ext}").unlink(missing_ok=True)
+
+    def get(self, key, dst):
+        """clones the key filtered history in dst (bare): returns a Git or None"""
+        bundle = self.path / f"{key}.bundle"
+        digest = self.path / f"{key}.sha256"
+        mapping = self.path / f"{key}.map"
+        if not (bundle.exists() and digest.exists() and mapping.exists()):
+            return None
+        if digest.read_text().strip() != self.checksum(bundle, mapping):
+            log.warning("dropping corrupted filter cache entry %s", bundle)
+            self.drop(key)
+            return None
+        try:
+            run(["git", "clone", "-q", "--bare", bundle, dst])
+        except subprocess.CalledProcessError:
+            log.warning("dropping unusable filter cache entry %s", bundle)
+            shutil.rmtree(dst, ignore_errors=True)
+            self.drop(key)
+            return None
+        git = Git(dst)
+        path = git.gitpath("mono2repo/filter-map")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(mapping, path)
+        os.utime(bundle)
+        return git
+
+    def put(self, key, git):
+        """stores the git (filtered) history under key"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        bundle = self.path / f"{key}.bundle"
+        tmp = bundle.with_name(f"{bundle.name}.{os.getpid()}.tmp")
+        mapping = self.path / f"{key}.map"
+        try:
+            git.run(["bundle", "create", "-q", tmp, "--all"])
+            write_filter_map(mapping, read_filter_map(git) or {})
+            digest = self.checksum(tmp, mapping)
+            (self.path / f"{key}.sha256").write_text(f"{digest}\n")
+            tmp.rename(bundle)
+        finally:
+            tmp.unlink(missing_ok=True)
+        self.evict(keep={bundle})
+        return bundle
+
+    def entries(self):
+        """returns the bundles as (path, last-used, size) tuples, oldest first"""
+        result = []
+        for path in self.path.glob("*.bundle"):
+            stat = path.stat()
+            result.append((path, stat.st_mtime, stat.st_size))
+        return sorted(result, key=lambda entry: entry[1])
+
+    def evict(self, keep=()):
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        evicted = []
+        for path, used, size in entries:
+            old = self.maxage is not None and time.time() - used > self.maxage
+            big = self.maxsize is not None and total > self.maxsize
+            if path in keep or not (old or big):
+                continue
+            log.debug("evicting filtered history %s (%i bytes)", path, size)
+            self.drop(path.stem)
+            total -= size
+            evicted.append(path)
+        return evicted
+
+
+class ObjectStore:
+    """a bare repo holding the objects of many outputs (opt-in, see attach)
+
+    The attached outputs borrow the store objects (alternates) and keep only
+    the ones not in it: sync moves the output objects in the store and
+    mirrors the output refs under refs/mono2repo/<key>/, so a gc of the
+    store never prunes an object an output needs (and a gc of an output
+    repacks only its own objects). The outputs are registered as
+    <path>/mono2repo/outputs/<key> files (no lock needed, see maintain).
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path).expanduser().resolve()
+        self.git = Git(self.path)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} path={self.path} at {hex(id(self))}>"
+
+    def key(self, git):
+        return hashlib.sha1(str(git.worktree.resolve()).encode("utf-8")).hexdigest()
+
+    @property
+    def registry(self):
+        return self.path / "mono2repo" / "outputs"
+
+    def outputs(self):
+        """the {key: output path} registered outputs"""
+        if not self.registry.exists():
+            return {}
+        return {
+            path.name: pathlib.Path(path.read_text().strip())
+            for path in self.registry.iterdir()
+            if not path.name.endswith(".tmp")
+        }
+
+    def create(self):
+        if not self.git.good():
+            log.debug("creating object store %s", self.path)
+            self.git.init(bare=True)
+            # the store gc is left to maintain (after a sync of the outputs)
+            self.git.run(["config", "gc.auto", "0"])
+        self.registry.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def attach(self, git):
+        """makes the git output (a new one) borrow and feed the store objects"""
+        self.create()
+        path = self.registry / self.key(git)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(f"{git.worktree.resolve()}\n")
+        os.replace(tmp, path)
+        git.run(["config", "--local", "mono2repo.store", str(self.path)])
+        git.borrow(self.git.gitpath("objects"))
+
+    def attached(self, git):
+        """whether the git output borrows the store objects"""
+        alternates = git.gitpath("objects/info/alternates")
+        lines = alternates.read_text().split("\n") if alternates.exists() else []
+        return str(self.git.gitpath("objects")) in lines
+
+    def sync(self, git):
+        """moves the git output objects in the store (with its refs)
+
+        The other borrowed objects (eg. the upstream clone ones) reachable
+        from the output refs go in the store too, then the output keeps
+        borrowing only from the store and drops its copies. An output not
+        borrowing from the store (eg. dissociated) is left alone.
+        """
+        if not self.attached(git):
+            log.debug("%s doesn't borrow from %s", git, self.path)
+            return
+        alternates = git.gitpath("objects/info/alternates")
+        objects = f"{self.git.gitpath('objects')}\n"
+        if alternates.read_text() != objects:
+            # the rebased away commits (only in the reflogs) are not fetched,
+            # they are in the borrowed objects about to go
+            git.run(["reflog", "expire", "--expire-unreachable=now", "--all"])
+        # kept as a pack: the output repack drops the loose copies of the
+        # packed objects only
+        ref = f"refs/mono2repo/{self.key(git)}"
+        self.git.run(
+            ["-c", "fetch.unpackLimit=1", "fetch", "-q", "--prune", "--no-tags"]
+            + [git.worktree, f"+refs/*:{ref}/*"]
+        )
+        alternates.write_text(objects)
+        git.run(["repack", "-a", "-d", "-l", "-q"])
+
+    def detach(self, key):
+        """forgets the key output: its objects can be pruned by the store gc"""
+        refs = self.git.run(
+            ["for-each-ref", "--format=%(refname)", f"refs/mono2repo/{key}/"]
+        )
+        for ref in refs.split():
+            self.git.run(["update-ref", "-d", ref])
+        (self.registry / key).unlink(missing_ok=True)
+
+    def maintain(self, prune="2.weeks.ago"):
+        """syncs the outputs and gcs the store, returns the (before, after) bytes
+
+        The outputs gone (attached elsewhere or dissociated) are detached, the
+        unreachable objects are pruned only once older than prune (as git gc
+        does), so an output being written meanwhile is never broken.
+        """
+        if not self.git.good():
+            raise Mono2RepoError("no object store in", self.path)
+        before = self.git.size()
+        for key, output in sorted(self.outputs().items()):
+            git = Git(output)
+            store = git.config("mono2repo.store", local=True) if git.good() else None
+            if (
+                store != str(self.path)
+                or self.key(git) != key
+                or not self.attached(git)
+            ):
+                log.info("detaching %s from %s", output, self.path)
+                self.detach(key)
+                continue
+            with profiler.phase(f"sync {output}"):
+                self.sync(git)
+        # the refs of outputs not registered (eg. a failed attach)
+        keys = set(self.outputs())
+        for ref in self.git.run_lines(["for-each-ref", "--format=%(refname)"]):
+            parts = ref.split("/")
+            if parts[:2] == ["refs", "mono2repo"] and parts[2] not in keys:
+                self.git.run(["update-ref", "-d", ref])
+        with profiler.phase("gc"):
+            self.git.run(["gc", "-q", f"--prune={prune}"])
+        after = self.git.size()
+        log.info(
+            "maintained %s (%i outputs): %s -> %s",
+            self.path,
+            len(keys),
+            format_size(before),
+            format_size(after),
+        )
+        return before, after
+
+
+# fast-export / fast-import streaming
+#   git fast-export --no-data (one history read) -> parse_stream (events)
+#   -> SubdirFilter (one per output) -> FastImport (one git process per output)
+# Blobs are never read: the outputs borrow them from the source objects
+# (alternates) while importing and copy them in with a final repack.
+FAST_EXPORT = [
+    "fast-export",
+    "--no-data",
+    "--show-original-ids",
+    "--signed-tags=strip",
+    "--reencode=yes",
+    "--use-done-feature",
+    # eg. for start..end the first commits refer to their (excluded) parents
+    "--reference-excluded-parents",
+    # and the annotated tags of excluded commits too
+    "--tag-of-filtered-object=rewrite",
+]
+
+FAST_IMPORT = ["fast-import", "--quiet", "--date-format=raw-permissive"]
+
+_UNESCAPES = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"f": b"\f",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+    b'"': b'"',
+    b"\\": b"\\",
+}
+
+
+def unquote_path(path):
+    """decodes a (C style) quoted fast-export path"""
+    if not path.startswith(b'"'):
+        return path
+    result, i, end = bytearray(), 1, len(path) - 1
+    while i < end:
+        if path[i : i + 1] != b"\\":
+            result += path[i : i + 1]
+            i += 1
+        elif path[i + 1 : i + 2].isdigit():
+            result.append(int(path[i + 1 : i + 4], 8))
+            i += 4
+        else:
+            result += _UNESCAPES[path[i + 1 : i + 2]]
+            i += 2
+    return bytes(result)
+
+
+def quote_path(path):
+    if not (path.startswith(b'"') or b"\n" in path):
+        return path
+    escaped = path.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+    return b'"' + escaped.replace(b"\n", b"\\n") + b'"'
+
+
+class Commit:
+    def __init__(self, ref):
+        self.ref = ref
+        self.mark = None
+        self.headers = []  # original-oid/author/committer/encoding lines
+        self.message = b""
+        self.parents = []  # from + merge datarefs (eg. b":12")
+        self.changes = []  # (b"M", mode, dataref, path) or (b"D", path)
+
+
+class Reset:
+    def __init__(self, ref, parent=None):
+        self.ref = ref
+        self.parent = parent
+
+
+class Tag:
+    def __init__(self, name):
+        self.name = name
+        self.parent = None
+        self.headers = []  # mark/original-oid/tagger lines
+        self.message = b""
+
+
+class _Reader:
+    def __init__(self, fp):
+        self.fp = fp
+        self.pending = None
+        self.nbytes = 0
+
+    def line(self):
+        if self.pending is not None:
+            line, self.pending = self.pending, None
+            return line
+        line = self.fp.readline()
+        self.nbytes += len(line)
+        return line
+
+    def unread(self, line):
+        self.pending = line
+
+    def data(self, line):
+        assert line.startswith(b"data "), f"expecting data, got {line!r}"
+        data = self.fp.read(int(line[5:]))
+        self.nbytes += len(data)
+        return data
+
+
+def parse_stream(fp):
+    """yields Commit/Reset/Tag (or the raw line) events from a fast-export stream"""
+    reader = fp if isinstance(fp, _Reader) else _Reader(fp)
+    while True:
+        line = reader.line()
+        if not line:
+            return
+        if line.startswith(b"commit "):
+            commit = Commit(line[7:].rstrip(b"\n"))
+            while True:
+                line = reader.line()
+                if line.startswith(b"mark :"):
+                    commit.mark = int(line[6:])
+                elif line.startswith(b"data "):
+                    commit.message = reader.data(line)
+                elif line.startswith((b"from ", b"merge ")):
+                    commit.parents.append(line.split(b" ", 1)[1].rstrip(b"\n"))
+                elif line.startswith(b"M "):
+                    mode, ref, path = line[2:].rstrip(b"\n").split(b" ", 2)
+                    commit.changes.append((b"M", mode, ref, unquote_path(path)))
+                elif line.startswith(b"D "):
+                    commit.changes.append((b"D", unquote_path(line[2:].rstrip(b"\n"))))
+                elif line == b"deleteall\n":
+                    commit.changes.append((b"deleteall",))
+                elif line in {b"\n", b""}:
+                    break
+                else:
+                    commit.headers.append(line)
+            yield commit
+        elif line.startswith(b"reset "):
+            reset = Reset(line[6:].rstrip(b"\n"))
+            line = reader.line()
+            if line.startswith(b"from "):
+                reset.parent = line[5:].rstrip(b"\n")
+                line = reader.line()
+            if line != b"\n":
+                reader.unread(line)
+            yield reset
+        elif line.startswith(b"tag "):
+            tag = Tag(line[4:].rstrip(b"\n"))
+            while True:
+                line = reader.line()
+                if line.startswith(b"from "):
+                    tag.parent = line[5:].rstrip(b"\n")
+                elif line.startswith(b"data "):
+                    tag.message = reader.data(line)
+                    break
+                else:
+                    tag.headers.append(line)
+            yield tag
+        elif line != b"\n":
+            yield line
+
+
+class SubdirFilter:
+    """rewrites a fast-export stream keeping only subdir (moved to the root)
+
+    Commits left with no changes are pruned (unless they were empty to
+    begin with) and their children are attached to the nearest kept ancestor,
+    merges left with a redundant parent and no changes are pruned too (as
+    filter-repo does, the --no-ff merges are kept).
+    The excluded parents (eg. for ref ^HEAD) found in known, a {source oid:
+    written oid} dictionary, are kept as they are (see external).
+    No blob data is held in memory (fast-export --no-data, blobs go by oid)
+    but the marks, graph and original tables grow with the number of commits.
+    """
+
+    def __init__(self, subdir, git, onto=None, ref=None, committer=None, known=None):
+        self.subdir = str(subdir).strip("/")
+        self.prefix = f"{self.subdir}/".encode("utf-8") if self.subdir else b""
+        self.git = git  # the source repo
+        # grafting: root commits parent, single destination ref, committer
+        self.onto = onto.encode("utf-8") if onto else None
+        self.ref = ref.encode("utf-8") if ref else None
+        self.committer = committer.encode("utf-8") if committer else None
+        self.known = known or {}
+        self.nearest = {}  # excluded oid -> its nearest ancestor in known
+        self.marks = {}  # source commit mark -> kept mark (or None)
+        self.graph = {}  # kept mark (or written oid) -> (depth, parents, oid)
+        self.original = {}  # source mark (or oid) -> (depth, source parents)
+        self.tips = {}  # ref -> last source mark
+        self.session = None  # igit cat-file session (on first lookup)
+
+    def parent(self, dataref):
+        if dataref.startswith(b":"):
+            return self.marks.get(int(dataref[1:]))
+        return self.external(dataref.decode("utf-8"))
+
+    def external(self, oid):
+        # an excluded commit already written: its written oid (as bytes, the
+        # marks being int), the ones not touching subdir stand for their
+        # nearest ancestor touching it
+        if oid not in self.known and self.known and self.subdir:
+            if oid not in self.nearest:
+                cmd = ["rev-list", "-1", oid, "--", self.subdir]
+                self.nearest[oid] = self.git.run(cmd)
+            oid = self.nearest[oid]
+        if oid not in self.known:
+            return None
+        key = self.known[oid].encode("utf-8")
+        self.graph.setdefault(key, (-1, [], oid))
+        return key
+
+    @staticmethod
+    def dataref(mark):
+        return mark if isinstance(mark, bytes) else b":%i" % mark
+
+    def is_ancestor(self, mark, other, graph=None):
+        graph = self.graph if graph is None else graph
+        depth = graph[mark][0]
+        stack, seen = [other], set()
+        while stack:
+            current = stack.pop()
+            if current == mark:
+                return True
+            for parent in graph[current][1]:
+                if parent not in seen and graph[parent][0] >= depth:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    def rewritten(self, source):
+        # the source parent was pruned (or excluded and not touching subdir)
+        if isinstance(source, bytes):
+            return source.decode("utf-8") not in self.known
+        return self.marks.get(source) != source
+
+    def trim(self, source, mapped):
+        # the kept parents and, for a merge left with less than two non
+        # redundant parents, its new first parent: as in filter-repo a parent
+        # is redundant when it was rewritten to an ancestor of another parent,
+        # unless it already was one in the source (eg. a --no-ff merge)
+        kept = [
+            (p, s, self.rewritten(s)) for p, s in zip(mapped, source) if p is not None
+        ]
+        parents = [p for p, _, _ in kept]
+        if len(kept) < 2:
+            return parents, None
+        unique = []
+        for p, s, rewritten in kept:
+            if not rewritten or p not in [u[0] for u in unique]:
+                unique.append((p, s, rewritten))
+        redundant = set()
+        for i, (p, s, rewritten) in enumerate(unique):
+            if rewritten and any(
+                i != j
+                and self.is_ancestor(p, q)
+                and not self.is_ancestor(s, t, self.original)
+                for j, (q, t, _) in enumerate(unique)
+            ):
+                redundant.add(i)
+        unique = [u for i, u in enumerate(unique) if i not in redundant]
+        if len(unique) < 2:
+            return parents, unique[0][0]
+        return [u[0] for u in unique], None
+
+    def path(self, path):
+        if path.startswith(self.prefix):
+            return path[len(self.prefix) :]
+
+    def tree(self, oid):
+        spec = f"{oid}:{self.subdir}" if self.subdir else f"{oid}^{{tree}}"
+        self.session = self.session or self.git.session()
+        info = self.session.info(spec)
+        return info[0] if info and info[1] == "tree" else None
+
+    def listing(self, oid):
+        # the full subdir tree of the source commit oid, as changes: the
+        # trees are read level by level (each level a pipelined lookup)
+        tree = self.tree(oid)
+        changes = [(b"deleteall",)]
+        level = [(tree, b"")] if tree else []
+        while level:
+            subtrees = []
+            answers = self.session.reads(t for t, _ in level)
+            for (tree, prefix), (_, _, content) in zip(level, answers):
+                for mode, name, ref in parse_tree(content, len(tree) // 2):
+                    if mode == b"40000":
+                        subtrees.append((ref.decode("utf-8"), prefix + name + b"/"))
+                    else:
+                        changes.append((b"M", mode, ref, prefix + name))
+            level = subtrees
+        return changes
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+    def commit(self, commit):
+        changes = []
+        for change in commit.changes:
+            if change[0] == b"deleteall":
+                changes.append(change)
+            elif self.path(change[-1]):
+                changes.append(change[:-1] + (self.path(change[-1]),))
+
+        oid = None
+        for header in commit.headers:
+            if header.startswith(b"original-oid "):
+                oid = header[13:].strip().decode("utf-8")
+
+        source = [int(p[1:]) if p.startswith(b":") else p for p in commit.parents]
+        for parent in source:
+            self.original.setdefault(parent, (-1, []))
+        depth = max((self.original[p][0] for p in source), default=-1) + 1
+        self.original[commit.mark] = (depth, source)
+
+        mapped = [self.parent(p) for p in commit.parents]
+        parents, first = self.trim(source, mapped)
+        self.tips[commit.ref] = commit.mark
+
+        if first is not None and oid and self.graph[first][2]:
+            # a merge left with redundant parents is pruned with no changes
+            if self.tree(oid) == self.tree(self.graph[first][2]):
+                self.marks[commit.mark] = first
+                return b""
+
+        if parents and parents[0] != mapped[0]:
+            # the changes are relative to a dropped first parent: compare
+            # the trees and use the full listing
+            if len(parents) == 1 and oid and self.graph[parents[0]][2]:
+                if self.tree(oid) == self.tree(self.graph[parents[0]][2]):
+                    self.marks[commit.mark] = parents[0]
+                    return b""
+            changes = self.listing(oid)
+        elif commit.parents and not parents and changes:
+            # the parents were pruned or cut off (eg. a ref forking before
+            # the bound of the history): the changes are relative to a tree
+            # not written
+            changes = self.listing(oid)
+
+        # commits empty to begin with are kept (unless their parent was pruned)
+        empty = not commit.changes and len(commit.parents) < 2
+        if empty and commit.parents and commit.parents[0].startswith(b":"):
+            empty = mapped[0] is not None and b":%i" % mapped[0] == commit.parents[0]
+        elif empty and commit.parents:
+            empty = commit.parents[0].decode("utf-8") in self.known
+        if not (changes or len(parents) > 1 or empty):
+            self.marks[commit.mark] = parents[0] if parents else None
+            return b""
+        self.marks[commit.mark] = commit.mark
+        depth = max((self.graph[p][0] for p in parents), default=-1) + 1
+        self.graph[commit.mark] = (depth, parents, oid)
+
+        ref = self.ref or commit.ref
+        headers = commit.headers
+        if self.committer:
+            author = [h for h in headers if h.startswith(b"author ")][0]
+            date = b" ".join(author.split()[-2:])
+            headers = [
+                b"committer %s %s\n" % (self.committer, date)
+                if h.startswith(b"committer ")
+                else h
+                for h in headers
+            ]
+
+        out = []
+        if not parents and not self.onto:
+            out.append(b"reset %s\n" % ref)
+        out.append(b"commit %s\nmark :%i\n" % (ref, commit.mark))
+        out.extend(headers)
+        out.append(b"data %i\n%s" % (len(commit.message), commit.message))
+        if parents:
+            out.append(b"from %s\n" % self.dataref(parents[0]))
+            out.extend(b"merge %s\n" % self.dataref(p) for p in parents[1:])
+        elif self.onto:
+            out.append(b"from %s\n" % self.onto)
+        for change in changes:
+            if change[0] == b"M":
+                out.append(b"M %s %s %s\n" % (*change[1:3], quote_path(change[3])))
+            elif change[0] == b"D":
+                out.append(b"D %s\n" % quote_path(change[1]))
+            else:
+                out.append(b"deleteall\n")
+        out.append(b"\n")
+        return b"".join(out)
+
+    def commit_map(self, marks):
+        """the {source oid: new oid} of the kept commits, given the import marks"""
+        return {
+            self.graph[mark][2]: oid
+            for mark, oid in marks.items()
+            if mark in self.graph and self.graph[mark][2]
+        }
+
+    def finish(self):
+        # refs whose last commits were pruned point to the nearest kept one
+        out = []
+        for ref, mark in self.tips.items():
+            if self.marks.get(mark) not in {mark, None}:
+                ref, parent = self.ref or ref, self.dataref(self.marks[mark])
+                out.append(b"reset %s\nfrom %s\n\n" % (ref, parent))
+        return b"".join(out)
+
+    def __call__(self, event):
+        if isinstance(event, Commit):
+            return self.commit(event)
+        elif isinstance(event, Reset):
+            # root commits get their own reset
+            if event.parent is None:
+                return b""
+            mark = self.parent(event.parent)
+            self.tips.pop(event.ref, None)
+            if mark is None:
+                return b""
+            ref = self.ref or event.ref
+            return b"reset %s\nfrom %s\n\n" % (ref, self.dataref(mark))
+        elif isinstance(event, Tag):
+            mark = self.parent(event.parent)
+            if mark is None:
+                return b""
+            return b"".join(
+                [
+                    b"tag %s\nfrom %s\n" % (event.name, self.dataref(mark)),
+                    *event.headers,
+                    b"data %i\n%s\n" % (len(event.message), event.message),
+                ]
+            )
+        elif event == b"done\n":
+            return self.finish() + event
+        return event
+
+
+class CatFile:
+    """long-running git cat-file processes answering object lookups
+
+    Each lookup is a line written to cat-file stdin and its answer read back
+    from stdout, no git is forked per object; the lookups of many objects
+    are pipelined (a thread writes the requests while the answers are read):
+        with git.session() as session:
+            session.info("HEAD:subdir")  # (oid, type, size) or None
+            session.read("HEAD")  # (oid, type, content) or None
+            session.infos(["HEAD~1", "HEAD~2"])  # [(oid, type, size), ...]
+    """
+
+    def __init__(self, git):
+        self.git = git
+        self.processes = {}  # mode -> [process, start, output size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def process(self, mode):
+        if mode not in self.processes:
+            process = subprocess.Popen(
+                ["git", "-C", str(self.git.worktree), "cat-file", mode],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            self.processes[mode] = [process, time.perf_counter(), 0]
+        return self.processes[mode]
+
+    @staticmethod
+    def request(process, specs):
+        with contextlib.suppress(BrokenPipeError):
+            for spec in specs:
+                process.stdin.write(b"%s\n" % spec)
+            process.stdin.flush()
+
+    def lookup(self, mode, specs):
+        entry = self.process(mode)
+        process = entry[0]
+        specs = [str(spec).encode("utf-8") for spec in specs]
+        if any(b"\n" in spec for spec in specs):
+            raise ValueError("invalid object name", specs)
+
+        writer = None
+        if len(specs) > 1:
+            writer = threading.Thread(target=self.request, args=(process, specs))
+            writer.start()
+        else:
+            self.request(process, specs)
+
+        result = []
+        try:
+            for _ in specs:
+                header = process.stdout.readline()
+                if not header:
+                    raise subprocess.CalledProcessError(process.poll(), process.args)
+                entry[2] += len(header)
+                # <oid> <type> <size> or <spec> missing (or ambiguous)
+                if not header.split()[-1].isdigit():
+                    result.append(None)
+                    continue
+                oid, kind, size = header.decode("utf-8").split()
+                size = int(size)
+                if mode == "--batch":
+                    content = process.stdout.read(size + 1)[:-1]
+                    entry[2] += size + 1
+                    result.append((oid, kind, content))
+                else:
+                    result.append((oid, kind, size))
+        finally:
+            if writer:
+                writer.join()
+        return result
+
+    def infos(self, specs):
+        return self.lookup("--batch-check", specs)
+
+    def info(self, spec):
+        return self.infos([spec])[0]
+
+    def reads(self, specs):
+        return self.lookup("--batch", specs)
+
+    def read(self, spec):
+        return self.reads([spec])[0]
+
+    def close(self):
+        for process, start, nbytes in self.processes.values():
+            process.stdin.close()
+            process.stdout.close()
+            code = process.wait()
+            profiler.record(process.args, time.perf_counter() - start, code, nbytes)
+        self.processes.clear()
+
+
+def parse_tree(content, size=20):
+    """yields the (mode, name, hex oid) entries of a raw tree object"""
+    pos = 0
+    while pos < len(content):
+        space = content.index(b" ", pos)
+        nul = content.index(b"\0", space)
+        oid = content[nul + 1 : nul + 1 + size].hex().encode("utf-8")
+        yield content[pos:space], content[space + 1 : nul], oid
+        pos = nul + 1 + size
+
+
+class FastImport:
+    """a git fast-import process writing into git (a bare repo)
+
+    Many can write into the same repo (each has its own marks file), force
+    lets them move the existing refs (eg. a rewritten upstream branch).
+    """
+
+    def __init__(self, git, alternates=(), force=False):
+        self.git = git
+        if alternates:
+            git.borrow(*alternates)
+        self.marks_path = git.gitpath(f"mono2repo-marks-{id(self)}")
+        self.marks = {}  # mark -> imported oid (once closed)
+        self.process = subprocess.Popen(
+            [
+                "git",
+                "-C",
+                str(git.worktree),
+                *FAST_IMPORT,
+                *(["--force"] if force else []),
+                f"--export-marks={self.marks_path}",
+            ],
+            stdin=subprocess.PIPE,
+        )
+        self.start = time.perf_counter()
+
+    def write(self, data):
+        if data:
+            self.process.stdin.write(data)
+
+    def close(self, dissociate=True):
+        self.process.stdin.close()
+        code = self.process.wait()
+        wall = time.perf_counter() - self.start
+        profiler.record(self.process.args, wall, code, 0)
+        if code:
+            raise subprocess.CalledProcessError(
+                self.process.returncode, self.process.args
+            )
+        if self.marks_path.exists():
+            for line in self.marks_path.read_text().split("\n"):
+                if line.startswith(":"):
+                    mark, oid = line[1:].split()
+                    self.marks[int(mark)] = oid
+            self.marks_path.unlink()
+        if dissociate:
+            self.git.dissociate()
+        return self.git
+
+
+def prefetch(git, subdirs, revs=("HEAD",)):
+    """fetches at once the blobs under subdirs in revs for a partial clone
+
+    A blobless clone would fetch each missing blob on first access, here
+    the blobs are listed from the trees (present in the clone) and fetched
+    with a single request. Returns the number of blobs requested.
+    """
+    if git.config("remote.origin.promisor") != "true":
+        return 0
+    pathspec = [subdir or "." for subdir in subdirs]
+    oids = set()
+    for line in git.run_lines(
+        ["log", "-m", "--no-renames", "--raw", "--no-abbrev", "--format="]
+        + [*revs, "--", *pathspec]
+    ):
+        # :<old mode> <new mode> <old oid> <new oid> <status>\t<path>
+        if line.startswith(":"):
+            _, mode, _, oid = line.split()[:4]
+            if mode != "160000" and oid.strip("0"):
+                oids.add(oid)
+    log.debug("prefetching %i blob(s) in %s", len(oids), git)
+    if oids:
+        cmd = ["git", "-C", str(git.worktree), "-c", "fetch.negotiationAlgorithm=noop"]
+        cmd += ["fetch", "--no-tags", "--no-write-fetch-head", "--filter=blob:none"]
+        cmd += ["--recurse-submodules=no", "--stdin", "origin"]
+        start = time.perf_counter()
+        process = subprocess.run(
+            cmd, input="".join(f"{oid}\n" for oid in sorted(oids)), encoding="utf-8"
+        )
+        profiler.record(cmd, time.perf_counter() - start, process.returncode, 0)
+        process.check_returncode()
+    return len(oids)
+
+
+def stream(igit, pipes, refs=("HEAD",)):
+    """feeds a single igit fast-export to the (filter, FastImport) pipes"""
+    try:
+        prefetch(igit, [flt.subdir for flt, _ in pipes], refs)
+        log.debug("fast-export from %s into %i repo(s)", igit, len(pipes))
+        start = time.perf_counter()
+        export = subprocess.Popen(
+            ["git", "-C", str(igit.worktree), *FAST_EXPORT, *refs],
+            stdout=subprocess.PIPE,
+        )
+        with export:
+            reader = _Reader(export.stdout)
+            for event in parse_stream(reader):
+                for flt, pipe in pipes:
+                    pipe.write(flt(event))
+        wall = time.perf_counter() - start
+        profiler.record(export.args, wall, export.returncode, reader.nbytes)
+        if export.returncode:
+            raise subprocess.CalledProcessError(export.returncode, export.args)
+    except BaseException:
+        for _, pipe in pipes:
+            pipe.process.kill()
+        raise
+    finally:
+        for flt, _ in pipes:
+            flt.close()
+
+
+def fanout(igit, targets, refs=("HEAD",), dissociate=True):
+    """filters igit history into many bare repos with a single fast-export
+
+    targets is a {subdir: destination path} dictionary, returns the
+    {subdir: Git} of the filtered bare repos; without dissociate these
+    keep borrowing the blobs from igit (fine for short lived repos).
+    """
+    if not targets:
+        # nothing to filter: no fast-export (nor a blobless prefetch of all)
+        return {}
+    objects = igit.gitpath("objects")
+    head = igit.run(["symbolic-ref", "-q", "HEAD"], abort=False)
+
+    pipes = []
+    for subdir, path in targets.items():
+        ogit = Git(path)
+        ogit.init(bare=True)
+        if head:
+            ogit.run(["symbolic-ref", "HEAD", head])
+        pipes.append((SubdirFilter(subdir, igit), FastImport(ogit, [objects])))
+    stream(igit, pipes, refs)
+
+    result = {}
+    for subdir, (flt, pipe) in zip(targets, pipes):
+        result[subdir] = pipe.close(dissociate)
+        path = result[subdir].gitpath("mono2repo/filter-map")
+        write_filter_map(path, flt.commit_map(pipe.marks))
+    return result
+
+
+def graft_history(igit, ogit, subdir, branch, onto="HEAD", refs=("HEAD",)):
+    """writes the igit history (filtered on subdir) as ogit branch
+
+    The root commits get the ogit onto as parent and the committer is the
+    current user with the author date (as rebase --committer-date-is-author-date
+    would do) but nothing is checked out: fast-import writes the objects.
+    With refs as start..end only the new commits are written (onto being
+    the filtered start). Returns the {igit oid: ogit oid} written commits.
+    """
+    onto = ogit.run(["rev-parse", onto])
+    ident = ogit.run(["var", "GIT_COMMITTER_IDENT"]).rsplit(" ", 2)[0]
+    flt = SubdirFilter(
+        subdir, igit, onto=onto, ref=f"refs/heads/{branch}", committer=ident
+    )
+    pipe = FastImport(ogit, [igit.gitpath("objects")])
+    stream(igit, [(flt, pipe)], refs)
+    pipe.close()
+    return flt.commit_map(pipe.marks)
+
+
+def match_refs(git, patterns):
+    """the {git ref: output ref} branches and tags with a name matching patterns
+
+    The patterns are globs (eg. release/*), the branch HEAD points to is
+    left out (that is the migrate branch) and the remote branches of a
+    clone with a worktree count as branches.
+    """
+    head = git.run(["symbolic-ref", "-q", "--short", "HEAD"], abort=False)
+    prefixes = {
+        "refs/heads/": "refs/heads/",
+        "refs/remotes/origin/": "refs/heads/",
+        "refs/tags/": "refs/tags/",
+    }
+    result = {}
+    for ref in git.run_lines(["for-each-ref", "--format=%(refname)"]):
+        for prefix, target in prefixes.items():
+            if not ref.startswith(prefix):
+                continue
+            name = ref[len(prefix) :]
+            if target == "refs/heads/" and name in {head, "HEAD"}:
+                continue
+            if target + name in result.values():
+                continue
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                result[ref] = target + name
+    return result
+
+
+def graft_refs(igit, ogit, subdir, refs, known, onto, workers=None):
+    """writes the igit refs (a {igit ref: ogit ref} dict) in ogit
+
+    Each ref is filtered and written on its own (its commits not in HEAD,
+    as graft_history does), at most workers at the same time: the excluded
+    parents in known ({igit oid: ogit oid}, eg. the migrate branch commits)
+    are reused, the other root commits get onto as parent.
+    Returns the {igit oid: ogit oid} written commits.
+    """
+    onto = ogit.run(["rev-parse", onto])
+    ident = ogit.run(["var", "GIT_COMMITTER_IDENT"]).rsplit(" ", 2)[0]
+
+    def one(src, dst):
+        flt = SubdirFilter(
+            subdir, igit, onto=onto, ref=dst, committer=ident, known=known
+        )
+        pipe = FastImport(ogit, force=True)
+        stream(igit, [(flt, pipe)], [src, "^HEAD"])
+        pipe.close(dissociate=False)
+        return flt.commit_map(pipe.marks)
+
+    import concurrent.futures
+
+    result, failed = {}, []
+    ogit.borrow(igit.gitpath("objects"))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(one, src, dst): dst for src, dst in refs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result.update(future.result())
+                except Exception:
+                    log.error("failed writing %s", futures[future], exc_info=True)
+                    failed.append(futures[future])
+    finally:
+        ogit.dissociate()
+    if failed:
+        raise Mono2RepoError("failed writing refs", sorted(failed))
+    return result
+
+
+def extract_refs(igit, ogit, subdir, patterns, known, migrate, workers=None):
+    """writes the igit branches and tags matching patterns in ogit
+
+    Those are written next to the migrate branch (see graft_refs), the
+    ones named as the master or migrate branches are skipped.
+    Returns the {igit oid: ogit oid} written commits.
+    """
+    refs = {}
+    for src, dst in match_refs(igit, patterns).items():
+        if dst in {"refs/heads/master", f"refs/heads/{migrate}"}:
+            log.warning("skipping %s, %s is in use", src, dst)
+        else:
+            refs[src] = dst
+    log.debug("extracting %i ref(s) matching %s", len(refs), patterns)
+    if not refs:
+        return {}
+    # the initial commit
+    onto = ogit.run(["rev-list", "--max-parents=0", migrate]).split()[-1]
+    return graft_refs(igit, ogit, subdir, refs, known, onto, workers)
+
+
+# upstream <-> extracted commits
+def read_filter_map(git):
+    """the {upstream oid: filtered oid} of a filtered repo (or None)
+
+    Written by fanout or by filter-repo (its pruned commits map to the null
+    oid and are left out).
+    """
+    for name in ["mono2repo/filter-map", "filter-repo/commit-map"]:
+        path = git.gitpath(name)
+        if path.exists():
+            break
+    else:
+        return None
+    result = {}
+    for line in path.read_text().split("\n")[1:]:
+        if line.strip():
+            old, new = line.split()
+            if new.strip("0"):
+                result[old] = new
+    return result
+
+
+def write_filter_map(path, mapping):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lines = [f"{old} {new}\n" for old, new in mapping.items()]
+    path.write_text("".join(["old new\n", *lines]))
+
+
+def compose(first, then):
+    """chains {a: b} and {b: c} into {a: c}, a None first is the identity"""
+    if first is None:
+        return dict(then)
+    return {a: then[b] for a, b in first.items() if b in then}
+
+
+def rebase(git, *args):
+    """git rebase args: returns the {old oid: new oid} rewritten commits"""
+    with tempfile.TemporaryDirectory() as hooks:
+        hook = pathlib.Path(hooks) / "post-rewrite"
+        hook.write_text('#!/bin/sh\ncat > "$(dirname "$0")/rewritten"\n')
+        hook.chmod(0o755)
+        git.run(["-c", f"core.hooksPath={hooks}", "rebase", *args])
+        path = pathlib.Path(hooks) / "rewritten"
+        lines = path.read_text().split("\n") if path.exists() else []
+    return dict(line.split()[:2] for line in lines if line.strip())
+
+
+class CommitMap:
+    """index of the upstream <-> extracted commits of an output repo
+
+    <gitdir>/mono2repo/commit-map holds a header line and two tables of
+    fixed size records: (upstream, extracted) sorted by upstream and
+    (extracted, upstream) sorted by extracted, so a lookup (by full or
+    abbreviated oid) is a binary search reading O(log n) records.
+    """
+
+    MAGIC = b"mono2repo-commit-map"
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    @classmethod
+    def of(cls, git):
+        return cls(git.gitpath("mono2repo/commit-map"))
+
+    def header(self, fp):
+        magic, count, size = fp.readline().split()
+        if magic != self.MAGIC:
+            raise Mono2RepoError("invalid commit map", self.path)
+        return fp.tell(), int(count), int(size)
+
+    def items(self):
+        """the whole {upstream oid: extracted oid} map"""
+        if not self.path.exists():
+            return {}
+        with open(self.path, "rb") as fp:
+            _, count, size = self.header(fp)
+            data = fp.read(count * 2 * size)
+        return {
+            data[n : n + size].hex(): data[n + size : n + 2 * size].hex()
+            for n in range(0, len(data), 2 * size)
+        }
+
+    def write(self, mapping):
+        size = len(next(iter(mapping), "")) // 2
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as fp:
+            fp.write(b"%s %i %i\n" % (self.MAGIC, len(mapping), size))
+            for table in [mapping.items(), ((e, u) for u, e in mapping.items())]:
+                for key, value in sorted(table):
+                    fp.write(bytes.fromhex(key) + bytes.fromhex(value))
+        os.replace(tmp, self.path)
+
+    def update(self, pairs, rewritten=None):
+        """adds the upstream -> extracted pairs, rewritten are the
+        {old extracted: new extracted} commits (eg. after a rebase)"""
+        mapping = self.items()
+        mapping.update(pairs)
+        if rewritten:
+            mapping = {u: rewritten.get(e, e) for u, e in mapping.items()}
+        if mapping:
+            self.write(mapping)
+        return mapping
+
+    def lookup(self, sha):
+        """the (upstream, extracted) pairs with either oid starting with sha"""
+        sha = sha.lower()
+        result = []
+        if not self.path.exists():
+            return result
+        with open(self.path, "rb") as fp:
+            start, count, size = self.header(fp)
+
+            def record(table, n):
+                fp.seek(start + (table * count + n) * 2 * size)
+                data = fp.read(2 * size)
+                return data[:size].hex(), data[size:].hex()
+
+            for table in range(2):
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if record(table, mid)[0][: len(sha)] < sha:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                for n in range(lo, count):
+                    key, value = record(table, n)
+                    if not key.startswith(sha):
+                        break
+                    result.append((key, value) if table == 0 else (value, key))
+        return list(dict.fromkeys(result))
+
+
 def parse_args(args=None):
     if isinstance(args, (list, tuple, None.__class__)):
         args = None if args is None else [str(a) for a in args]
@@ -197,6 +2034,22 @@ Eg.
         p.set_defaults(func=func)
         p.add_argument("-v", "--verbose", action="store_true")
         p.add_argument("--tmpdir", type=pathlib.Path)
+        p.add_argument(
+            "--profile",
+            type=pathlib.Path,
+            help="write a json report with the phases/commands timings",
+        )
+        p.add_argument(
+            "--cache",
+            type=pathlib.Path,
+            default=os.getenv("MONO2REPO_CACHE"),
+            help="directory holding the persistent upstream mirrors",
+        )
+        p.add_argument(
+            "--cache-size",
+            type=parse_size,
+            help="evict least recently used mirrors above this size (eg. 20G)",
+        )
         p.add_argument(
             "--branch",
             dest="migrate",
@@ -205,15 +2058,234 @@ Eg.
         )
         return p
 
+    def blobless(p):
+        p.add_argument(
+            "--blobless",
+            action="store_true",
+            help="partial clone of the upstream with only the subdir blobs "
+            "(fetched at once), needs the native backend",
+        )
+
+    def sparse(p):
+        p.add_argument(
+            "--sparse",
+            action="store_true",
+            help="give the upstream clone a worktree with only the subdir "
+            "checked out (instead of a bare clone)",
+        )
+
+    def store(p):
+        p.add_argument(
+            "--store",
+            type=pathlib.Path,
+            default=os.getenv("MONO2REPO_STORE"),
+            help="shared object store (a bare repo, created if missing) the "
+            "output borrows the objects from, see the maintain action",
+        )
+
+    def refs(p):
+        p.add_argument(
+            "--refs",
+            action="append",
+            metavar="GLOB",
+            help="extract the upstream branches and tags matching GLOB too "
+            "(eg. 'release/*', can be repeated)",
+        )
+        p.add_argument(
+            "-j",
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="number of refs written at the same time",
+        )
+
+    def repack(p):
+        p.add_argument(
+            "--finalize",
+            action="store_true",
+            help="repack the output for the downstream clones (bitmaps, "
+            "multi-pack-index and a commit-graph with Bloom filters)",
+        )
+        p.add_argument(
+            "--repack-window",
+            type=int,
+            default=250,
+            help="delta window of the --finalize repack",
+        )
+        p.add_argument(
+            "--repack-depth",
+            type=int,
+            default=50,
+            help="delta depth of the --finalize repack",
+        )
+        p.add_argument(
+            "--repack-threads",
+            type=int,
+            help="threads of the --finalize repack (default: all the cpus)",
+        )
+
+    def backend(p):
+        p.add_argument(
+            "--backend",
+            choices=BACKENDS,
+            default="filter-repo",
+            help="history filter: git filter-repo or the built-in "
+            "fast-export/fast-import one (native)",
+        )
+
     # init
     p = subparser("init", init)
+    backend(p)
+    blobless(p)
+    sparse(p)
+    refs(p)
+    repack(p)
+    store(p)
+    p.add_argument(
+        "--graft",
+        action="store_true",
+        help="write the history on top of the initial commit with "
+        "fast-import instead of a rebase",
+    )
+    p.add_argument(
+        "--filter-cache",
+        type=pathlib.Path,
+        default=os.getenv("MONO2REPO_FILTER_CACHE"),
+        help="directory holding the filtered histories (reused for the same "
+        "upstream commit, subdir and backend)",
+    )
+    p.add_argument(
+        "--filter-cache-size",
+        type=parse_size,
+        help="evict least recently used filtered histories above this size",
+    )
+    p.add_argument(
+        "--filter-cache-age",
+        type=float,
+        help="evict filtered histories not used in this many days",
+    )
+    p.add_argument(
+        "--since",
+        help="extract only the history after this date (eg. 2.years.ago)",
+    )
+    p.add_argument(
+        "--since-ref",
+        help="extract only the history after this commit (eg. a tag)",
+    )
+    p.add_argument(
+        "--max-commits",
+        type=int,
+        help="extract only the last max commits touching the subdir",
+    )
     p.add_argument("output", type=pathlib.Path)
     p.add_argument("uri")
 
     p = subparser("update", update)
+    backend(p)
+    blobless(p)
+    sparse(p)
+    refs(p)
+    repack(p)
+    p.add_argument(
+        "--graft",
+        action="store_true",
+        help="write the new commits on top of the migrate branch with "
+        "fast-import (no checkout) instead of git am and a rebase",
+    )
+    p.add_argument(
+        "--no-fetch",
+        dest="fetch",
+        action="store_false",
+        help="use the --cache mirror as it is, without refreshing it",
+    )
     p.add_argument("output", type=pathlib.Path)
     p.add_argument("uri", nargs="?")
 
+    # what init (with uri) or update would do, read only
+    p = subparser("plan", plan)
+    backend(p)
+    blobless(p)
+    sparse(p)
+    p.add_argument(
+        "--graft",
+        action="store_true",
+        help="plan an init/update --graft",
+    )
+    p.add_argument("output", type=pathlib.Path)
+    p.add_argument("uri", nargs="?")
+
+    # each output is updated in its own mono2repo update subprocess
+    p = subparser("update-all", update_all)
+    backend(p)
+    repack(p)
+    p.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of updates running at the same time",
+    )
+    p.add_argument(
+        "--per-source",
+        type=int,
+        help="number of updates running at the same time from the same upstream",
+    )
+    p.add_argument(
+        "roots",
+        nargs="+",
+        type=pathlib.Path,
+        help="extracted repos or directories to search for them",
+    )
+
+    # projects are always filtered with the built-in fanout
+    p = subparser("extract-many", extract_many)
+    p.set_defaults(backend="native")
+    blobless(p)
+    store(p)
+    p.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of projects extracted in parallel",
+    )
+    p.add_argument(
+        "manifest",
+        type=pathlib.Path,
+        help="file with a '<subdir> <output>' pair per line",
+    )
+    p.add_argument("uri")
+
+    # a lookup only, without the clone options
+    p = sbs.add_parser("map")
+    p.set_defaults(func=commit_map, backend=None, profile=None)
+    p.add_argument("-v", "--verbose", action="store_true")
+    p.add_argument(
+        "-C",
+        "--output",
+        type=pathlib.Path,
+        default=pathlib.Path("."),
+        help="the extracted repo",
+    )
+    p.add_argument("sha", help="an upstream or extracted commit (or its prefix)")
+
+    # syncs the outputs of a shared object store and gcs it
+    p = sbs.add_parser("maintain")
+    p.set_defaults(func=maintain, backend=None, profile=None)
+    p.add_argument("-v", "--verbose", action="store_true")
+    p.add_argument(
+        "--prune",
+        default="2.weeks.ago",
+        help="prune the unreachable objects older than this (as git gc)",
+    )
+    p.add_argument(
+        "store",
+        type=pathlib.Path,
+        nargs="?",
+        default=os.getenv("MONO2REPO_STORE"),
+        help="the shared object store",
+    )
+
     options = parser.parse_args(args)
     options.error = parser.error
 
@@ -221,113 +2293,487 @@ Eg.
     return options
 
 
-def init(igit, ogit, subdir, migrate):
-    assert (igit.worktree / subdir).exists()
+BACKENDS = ["filter-repo", "native"]
 
-    # prepping the legacy tree
+
+def filter_subdir(igit, subdir, backend="filter-repo", refs=("HEAD",)):
+    """rewrites the igit history keeping only subdir (moved to the root)
+
+    filter-repo rewrites igit in place (all the refs), native streams the
+    refs history into a new bare repo next to igit (see fanout): returns
+    the filtered Git.
+    """
+    if not subdir:
+        return igit
+    if backend == "native":
+        path = igit.worktree.with_name(f"{igit.worktree.name}-filtered.git")
+        return fanout(igit, {subdir: path}, refs, dissociate=False)[subdir]
+    igit.run(filter_repo_args(subdir))
+    return igit
+
+
+def filter_repo_args(subdir):
+    # --force: clones from the mirror cache are not "freshly packed"
+    return [
+        "filter-repo",
+        "--force",
+        "--path",
+        f"{subdir}/",
+        "--path-rename",
+        f"{subdir}/:",
+    ]
+
+
+def first_date(git, pathspec=()):
+    """the committer date of the first commit (eg. log --reverse -1)"""
+    if pathspec:
+        # the path limited roots aren't real roots: stop after the first line
+        for line in git.run_lines(["log", "--reverse", "--format=%cd", *pathspec]):
+            return line
+    else:
+        # the last root listed is the last commit listed by log
+        lines = git.run_lines(["rev-list", "--max-parents=0", "--format=%cd", "HEAD"])
+        last = collections.deque(
+            (line for line in lines if not line.startswith("commit ")), maxlen=1
+        )
+        if last:
+            return last[0]
+    raise Mono2RepoError("no commits in", git)
+
+
+def bound(igit, subdir, since=None, since_ref=None, max_commits=None):
+    """the commit a bounded history starts from (or None for the whole one)
+
+    That is the last commit touching subdir before the date since, at the
+    since_ref commit or before the last max_commits ones touching subdir
+    (the most recent of these): only its descendants are extracted, on top
+    of a root commit with its tree.
+    """
+    pathspec = ["--", subdir] if subdir else []
+    bounds = []
+    if since:
+        cmd = ["rev-list", "-1", "--first-parent", f"--before={since}", "HEAD"]
+        bounds.append(igit.run(cmd))
+    if since_ref:
+        cmd = ["rev-parse", "--verify", "-q", f"{since_ref}^{{commit}}"]
+        error = Mono2RepoError("invalid --since-ref", since_ref)
+        bounds.append(igit.run(cmd, abort=error, silent=True))
+    if max_commits:
+        cmd = ["rev-list", "-1", f"--skip={max_commits}", "HEAD", *pathspec]
+        bounds.append(igit.run(cmd))
+    bounds = [igit.run(["rev-list", "-1", b, *pathspec]) for b in bounds if b]
+    bounds = [b for b in bounds if b]
+    if not bounds:
+        return None
+
+    def after(commit):
+        return int(igit.run(["rev-list", "--count", f"{commit}..HEAD"]))
+
+    # the most recent one: the fewest commits after it
+    return min(bounds, key=after)
+
+
+def shallow_args(source, since=None, since_ref=None):
+    """the clone --shallow-* flags leaving out the history before the bounds
+
+    since_ref is excluded by its full name when it is a source branch or
+    tag, otherwise (eg. a commit) the whole history is cloned: the commits
+    can't be asked for by id.
+    """
+    flags = [f"--shallow-since={since}"] if since else []
+    if since_ref:
+        cmd = ["git", "ls-remote", "--refs", source, since_ref]
+        names = {line.split()[-1] for line in run(cmd).split("\n") if line}
+        for name in [since_ref, f"refs/tags/{since_ref}", f"refs/heads/{since_ref}"]:
+            if name in names:
+                return [*flags, f"--shallow-exclude={name}"]
+        return []
+    return flags
+
+
+def init(
+    igit,
+    ogit,
+    subdir,
+    migrate,
+    backend="filter-repo",
+    graft=False,
+    filters=None,
+    since=None,
+    since_ref=None,
+    max_commits=None,
+    refs=(),
+    workers=None,
+    store=None,
+):
+    assert igit.tree(subdir)
+
+    # prepping the legacy tree (a cached filtered one records its upstream)
+    head = igit.config("mono2repo.upstream") or igit.run(["rev-parse", "HEAD"])
+    base = None
+    if since or since_ref or max_commits:
+        with profiler.phase("bound"):
+            base = bound(igit, subdir, since, since_ref, max_commits)
+        log.debug("extracting the history after %s", base)
 
     # filter existing commits
-    log.debug("filtering existing commits")
-    igit.run(["filter-repo", "--path", f"{subdir}/", "--path-rename", f"{subdir}/:"])
+    pathspec = []
+    if graft and backend == "native" and not filters:
+        # filtered and grafted with a single fast-export below
+        pathspec = ["--", subdir] if subdir else []
+    elif subdir:
+        log.debug("filtering existing commits")
+        with profiler.phase("filter"):
+            revs = ["HEAD", *match_refs(igit, refs)] if refs else ["HEAD"]
+            filtered = filter_subdir(igit, subdir, backend, revs)
+        if filters:
+            with profiler.phase("store"):
+                filters.put(filters.key(head, subdir, backend), filtered)
+        igit, subdir = filtered, ""
+    # upstream -> filtered commits (None: igit is the upstream)
+    upstream = read_filter_map(igit)
+    start = base if base and upstream is None else (upstream or {}).get(base)
+    if base and not start:
+        log.warning("no filtered commit for %s, extracting the whole history", base)
 
     # extract latest mod date
     log.debug("get latest modification date")
-    txt = igit.run(["log", "--reverse", '--format="%t|%cd|%s"'])
-    date = txt.split("\n")[0].split("|")[1]
+    with profiler.phase("dates"):
+        if start:
+            date = igit.run(["log", "-1", "--format=%cd", start])
+        else:
+            date = igit.reader.first_date(pathspec)
     log.debug("got latest date [%s]", date)
 
     # Create a new (empty) repository
     log.debug("initializing work tree in %s", ogit.worktree)
-    ogit.init("master")
-    ogit.run(["commit", "--allow-empty", "-m", "Initial commit", "--date", date])
+    with profiler.phase("initialize"):
+        ogit.init("master")
+        if store:
+            store.attach(ogit)
+        message = "Initial commit"
+        if start:
+            # the root carries the starting tree (the objects being borrowed)
+            ogit.borrow(igit.gitpath("objects"))
+            ogit.run(["read-tree", "--reset", "-u", igit.tree(subdir, start)])
+            message += f"\n\nmono2repo: the history before {base} is not extracted"
+        ogit.run(["commit", "--allow-empty", "-m", message, "--date", date])
+    # igit -> ogit commits, the start commit counterpart is the root
+    known = {start: ogit.run(["rev-parse", "HEAD"])} if start else {}
+
+    if graft:
+        # write the history straight on top of the initial commit
+        log.debug("grafting %s into %s", igit, migrate)
+        with profiler.phase("graft"):
+            revs = [f"{start}..HEAD"] if start else ["HEAD"]
+            known.update(graft_history(igit, ogit, subdir, migrate, refs=revs))
+    else:
+        known.update(rebase_legacy(igit, ogit, migrate, start))
 
+    if refs:
+        with profiler.phase("refs"):
+            known.update(
+                extract_refs(igit, ogit, subdir, refs, known, migrate, workers)
+            )
+        ogit.run(["config", "--local", "mono2repo.refs", " ".join(refs)])
+    CommitMap.of(ogit).update(compose(upstream, known))
+    ogit.run(["config", "--local", "mono2repo.last", head])
+
+
+def rebase_legacy(igit, ogit, migrate, start=None):
+    """fetches the igit (filtered) history and rebases it on ogit master
+
+    The history after start only (if given), returns the {igit oid: ogit
+    oid} rebased commits.
+    """
     # Add legacy plugin clone as a remote and
-    #  pull contents into new branch
+    #  pull contents into new branch: the objects are borrowed for the
+    #  fetch (nothing is transferred) and copied once at the end
+    ogit.borrow(igit.gitpath("objects"))
     ogit.run(["remote", "add", "legacy", igit.worktree])
     try:
-        ogit.run(
-            [
-                "fetch",
-                "legacy",
-                "master",
-            ]
-        )
-        ogit.run(["checkout", "-b", migrate, "--track", "legacy/master"])
-        ogit.run(["rebase", "--committer-date-is-author-date", "master"])
+        with profiler.phase("fetch"):
+            ogit.run(
+                [
+                    "fetch",
+                    "legacy",
+                    "master",
+                ]
+            )
+        with profiler.phase("rebase"):
+            ogit.run(["checkout", "-b", migrate, "--track", "legacy/master"])
+            onto = ["--onto", "master", start] if start else ["master"]
+            rebased = rebase(ogit, "--committer-date-is-author-date", *onto)
     finally:
         ogit.run(["remote", "remove", "legacy"])
+        with profiler.phase("dissociate"):
+            ogit.dissociate()
 
     # Finally we switch to the master branch
-    ogit.run(["checkout", "master"], silent=True)
-
+    with profiler.phase("finalize"):
+        ogit.run(["checkout", "master"], silent=True)
+    return rebased
 
-def update(igit, ogit, subdir, migrate):
-    # prepping the legacy tree
 
-    # filter existing commits
-    igit.run(["filter-repo", "--path", f"{subdir}/", "--path-rename", f"{subdir}/:"])
+def replay(igit, ogit, subdir, start, end):
+    """applies the igit commits in start..end touching subdir on the ogit branch
 
-    # Add legacy plugin clone as a remote and
-    #  pull contents into new branch
-    ogit.run(["remote", "add", "legacy-repo", igit.worktree])
-    try:
-        ogit.run(
+    Only the new commits are turned into patches (relative to subdir) and
+    applied with git am, so the cost depends on the size of the change.
+    Returns the {igit oid: ogit oid} applied commits.
+    """
+    prefetch(igit, [subdir], [f"{start}..{end}"])
+    with tempdir() as tmp:
+        relative = [f"--relative={subdir}", "--", subdir] if subdir else []
+        patches = igit.run(
+            [
+                "format-patch",
+                "-k",
+                "-o",
+                tmp,
+                f"{start}..{end}",
+                *relative,
+            ]
+        ).split()
+        log.debug("replaying %i commit(s) from %s..%s", len(patches), start, end)
+        if not patches:
+            return {}
+        # the patches start with "From <igit oid> <date>"
+        oids = [pathlib.Path(patch).read_text().split()[1] for patch in patches]
+        before = ogit.run(["rev-parse", "HEAD"])
+        try:
+            ogit.run(["am", "-k", "--committer-date-is-author-date", *patches])
+        except subprocess.CalledProcessError:
+            ogit.run(["am", "--abort"], abort=False, silent=True)
+            raise
+    # each patch is a commit
+    applied = ogit.run(["rev-list", "--reverse", f"{before}..HEAD"]).split()
+    return dict(zip(oids, applied))
+
+
+def update(
+    igit,
+    ogit,
+    subdir,
+    migrate,
+    backend="filter-repo",
+    graft=False,
+    refs=(),
+    workers=None,
+):
+    # prepping the legacy tree
+    head = igit.run(["rev-parse", "HEAD"])
+    # the refs extracted by init, unless given
+    refs = refs or (ogit.config("mono2repo.refs", local=True) or "").split()
+
+    last = ogit.config("mono2repo.last", local=True)
+    ancestor = ["merge-base", "--is-ancestor", last, head]
+    if last and igit.run(ancestor, abort=False, silent=True) is None:
+        # eg. the upstream history has been rewritten
+        log.debug("mono2repo.last [%s] not in upstream history", last)
+        last = None
+
+    # upstream -> filtered commits (None: igit is the upstream)
+    upstream = None
+    if last and graft:
+        # the new upstream commits since the last run on top of migrate
+        with profiler.phase("graft"):
+            old = ogit.run(["rev-parse", migrate])
+            grafted = graft_history(
+                igit, ogit, subdir, migrate, migrate, [f"{last}..{head}"]
+            )
+            if ogit.branch == migrate:
+                # the (clean) checkout follows the branch
+                ogit.run(["read-tree", "-u", "-m", old, migrate])
+        known = CommitMap.of(ogit).update(grafted)
+    elif last:
+        # only the new upstream commits since the last run
+        with profiler.phase("replay"):
+            applied = replay(igit, ogit, subdir, last, head)
+        with profiler.phase("rebase"):
+            rebased = rebase(ogit, "--committer-date-is-author-date", "master")
+        known = CommitMap.of(ogit).update(applied, rebased)
+    else:
+        # filter existing commits
+        log.debug("updating from the full upstream history")
+        with profiler.phase("filter"):
+            revs = ["HEAD", *match_refs(igit, refs)] if refs else ["HEAD"]
+            igit = filter_subdir(igit, subdir, backend, revs)
+        upstream, subdir = read_filter_map(igit), ""
+
+        # Add legacy plugin clone as a remote and
+        #  pull contents into new branch
+        ogit.run(["remote", "add", "legacy-repo", igit.worktree])
+        try:
+            with profiler.phase("fetch"):
+                ogit.run(
+                    [
+                        "fetch",
+                        "legacy-repo",
+                        "master",
+                    ]
+                )
+            with profiler.phase("rebase"):
+                ogit.run(["checkout", "-B", migrate, "--track", "legacy-repo/master"])
+                known = rebase(ogit, "--committer-date-is-author-date", "master")
+        finally:
+            ogit.run(["remote", "remove", "legacy-repo"])
+        CommitMap.of(ogit).update(compose(upstream, known), known)
+
+    if refs:
+        # the refs are written again, on top of the updated migrate branch
+        with profiler.phase("refs"):
+            written = extract_refs(igit, ogit, subdir, refs, known, migrate, workers)
+        CommitMap.of(ogit).update(compose(upstream, written))
+        ogit.run(["config", "--local", "mono2repo.refs", " ".join(refs)])
+    ogit.run(["config", "--local", "mono2repo.last", head])
+
+
+def finalize(git, window=250, depth=50, threads=None):
+    """repacks git for the downstream clones and history reads
+
+    The rewritten leftovers (rebased commits only in the reflogs) are
+    pruned, the rest goes in a single pack deltified again (window/depth,
+    threads None for all the cpus) with a multi-pack-index and reachability
+    bitmaps (clones, fetches) plus a commit-graph with the changed paths
+    Bloom filters (log -- path). Returns the (before, after) objects bytes.
+    An output attached to a store (see ObjectStore) packs only its own
+    objects, without bitmaps (these need all the objects in the repo).
+    """
+    before = git.size()
+    if git.config("mono2repo.store", local=True):
+        flags = ["-l"]
+    else:
+        flags = ["--write-bitmap-index"]
+    with profiler.phase("repack"):
+        git.run(["reflog", "expire", "--expire-unreachable=now", "--all"])
+        git.run(
             [
-                "fetch",
-                "legacy-repo",
-                "master",
+                "repack",
+                "-a",
+                "-d",
+                "-f",
+                "-q",
+                f"--window={window}",
+                f"--depth={depth}",
+                f"--threads={threads or 0}",
+                "--write-midx",
+                *flags,
             ]
         )
-        ogit.run(["checkout", "-B", migrate, "--track", "legacy-repo/master"])
-        ogit.run(["rebase", "--committer-date-is-author-date", "master"])
-    finally:
-        ogit.run(["remote", "remove", "legacy-repo"])
+    with profiler.phase("prune"):
+        git.run(["prune", "--expire=now"])
+    with profiler.phase("commit-graph"):
+        git.run(["commit-graph", "write", "--reachable", "--changed-paths"])
+    after = git.size()
+    log.info(
+        "finalized %s: %s -> %s", git.worktree, format_size(before), format_size(after)
+    )
+    return before, after
 
 
 @contextlib.contextmanager
-def universe(tmpdir, output, func, error, uri, migrate):
+def universe(
+    tmpdir,
+    output,
+    func,
+    error,
+    uri,
+    migrate,
+    cache=None,
+    fetch=True,
+    blobless=False,
+    graft=False,
+    filters=None,
+    backend="filter-repo",
+    sparse=False,
+    shallow=None,
+):
     """
     (ogit) output/
     (igit) <tmpdir>/legacy-repo
+    (cache) <cache>/<sha1 of source>.git (bare mirror of source)
     """
 
     ogit = Git(worktree=output.resolve())
     log.debug("output client %s", ogit)
 
-    if func == init and ogit.good():
-        error(f"directory already initialized, {ogit}")
+    with profiler.phase("prepare"):
+        if func == init and ogit.good():
+            error(f"directory already initialized, {ogit}")
+
+        branch = ogit.branch
+        if func == update:
+            if not ogit.good():
+                error(f"directory not ready/present/initialized, {ogit}")
+            if ogit.dirty():
+                error(
+                    f"directory not clean (eg. git status has modification) on {ogit}"
+                )
+            # grafting writes the branch without a checkout
+            if branch != migrate and not graft:
+                ogit.branch = migrate
+                log.debug("switched from branch %s on %s", branch, ogit)
 
-    branch = ogit.branch
-    if func == update:
-        if not ogit.good():
-            error(f"directory not ready/present/initialized, {ogit}")
-        if ogit.run(["status", "-s", "--porcelain"]).strip():
-            error(f"directory not clean (eg. git status has modification) on {ogit}")
-        if branch != migrate:
-            ogit.branch = migrate
-            log.debug("switched from branch %s on %s", branch, ogit)
-
-    if uri:
-        source, subdir = split_source(uri)
-    else:
-        log.debug(f"getting source/subdir info from {ogit}")
-        txt = ogit.run(["config", "--local", "--get", "mono2repo.uri"])
-        source, subdir = split_source(txt)
+        if uri:
+            source, subdir = split_source(uri)
+        else:
+            log.debug(f"getting source/subdir info from {ogit}")
+            txt = ogit.config("mono2repo.uri", local=True)
+            if not txt:
+                error(f"no mono2repo.uri config in {ogit}")
+            source, subdir = split_source(txt)
     log.debug("git repo source [%s]", source)
     log.debug("repo subdir [%s]", subdir)
 
     with tempdir(tmpdir) as tmp:
-        igit = Git.clone(source, tmp / "legacy-repo")
+        igit = None
+        if filters and subdir and func == init:
+            # an already filtered history, from the upstream commit
+            with profiler.phase("lookup"):
+                if cache:
+                    with cache.use(source, fetch=fetch) as mirror:
+                        head = mirror.run(["rev-parse", "HEAD"])
+                    fetch = False
+                else:
+                    head = run(["git", "ls-remote", source, "HEAD"]).split()[0]
+                key = filters.key(head, subdir, backend)
+                igit = filters.get(key, tmp / "legacy-repo")
+            if igit:
+                log.debug("found filtered history %s for %s", key, head)
+                igit.run(["config", "mono2repo.upstream", head])
+                subdir = ""
+        if not igit:
+            shared = isinstance(source, pathlib.Path) and not cache
+            with profiler.phase("clone"):
+                igit = Git.clone(
+                    source,
+                    tmp / "legacy-repo",
+                    cache=cache,
+                    fetch=fetch,
+                    bare=not sparse,
+                    blobless=blobless,
+                    shared=shared,
+                    sparse=subdir if sparse else None,
+                    # local sources are borrowed, the mirrors and the filter
+                    # cache keep whole histories
+                    shallow=(
+                        shallow_args(source, **shallow)
+                        if shallow and not (shared or cache or filters)
+                        else ()
+                    ),
+                )
         log.debug("input client %s", igit)
-        if not (igit.worktree / subdir).exists():
+        if not igit.tree(subdir):
             error(f"no subdir {subdir} under {igit}")
 
         try:
             yield ogit, igit, subdir
         finally:
-            if branch == migrate:
-                ogit.branch = branch
-                log.debug("restoring to old branch %s, %s", branch, ogit)
+            with profiler.phase("restore"):
+                if branch == migrate:
+                    ogit.branch = branch
+                    log.debug("restoring to old branch %s, %s", branch, ogit)
         if uri:
             # finally we'll leave the configuration parameters for the update
             log.debug("writing config uri in {ogit}")
@@ -341,26 +2787,697 @@ def universe(tmpdir, output, func, error, uri, migrate):
             )
 
 
-def main(args=None):
-    options = parse_args(args)
-    log.debug("found system %s", platform.uname().system.lower())
-    log.debug("git version [%s]", run(["git", "--version"]))
+def parse_manifest(path):
+    """reads the (subdir, output) pairs from a manifest file
+
+    # comments and blank lines are skipped
+    pelican/themes/notmyidea  notmyidea-extracted
+    pelican/themes/simple     simple-extracted
+    """
+    result = []
+    outputs = set()
+    for lineno, line in enumerate(pathlib.Path(path).read_text().split("\n"), 1):
+        line = line.partition("#")[0].strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise Mono2RepoError(f"invalid manifest line {path}:{lineno}", line)
+        subdir, output = fields[0].strip("/"), pathlib.Path(fields[1]).resolve()
+        if output in outputs:
+            raise Mono2RepoError(f"duplicate output {path}:{lineno}", output)
+        outputs.add(output)
+        result.append((subdir, output))
+    return result
+
+
+def _extract_one(filtered, output, uri, last, migrate, store=None):
+    # runs in a worker process: returns an error message (or None) and
+    # the profiler phases (store is the ObjectStore path)
+    profiler.reset()
+    try:
+        ogit = Git(worktree=output)
+        if ogit.good():
+            return f"directory already initialized, {ogit}", profiler.phases
+        # filtered holds the project at its root already
+        with profiler.phase(f"extract {output}"):
+            init(Git(filtered), ogit, "", migrate, store=store and ObjectStore(store))
+            ogit.run(["config", "--local", "mono2repo.uri", uri])
+            ogit.run(["config", "--local", "mono2repo.last", last])
+    except Exception as exc:
+        log.debug("failed extracting %s", uri, exc_info=True)
+        return f"{exc.__class__.__name__}: {exc}", profiler.phases
+    return None, profiler.phases
+
+
+def extract_many(
+    tmpdir,
+    manifest,
+    uri,
+    migrate,
+    cache=None,
+    workers=None,
+    blobless=False,
+    store=None,
+):
+    """extracts all the manifest projects from a single clone of uri
+
+    The projects are filtered all together with a single fast-export pass
+    (see fanout), then imported in the outputs in parallel.
+    Returns a {output: error message or None} dictionary.
+    """
+    source, basedir = split_source(uri)
+    projects = [
+        ("/".join(p for p in [basedir, subdir] if p), output)
+        for subdir, output in parse_manifest(manifest)
+    ]
+
+    result = {}
+    with tempdir(tmpdir) as tmp:
+        with profiler.phase("clone"):
+            igit = Git.clone(
+                source,
+                tmp / "legacy-repo",
+                cache=cache,
+                bare=True,
+                blobless=blobless,
+                shared=isinstance(source, pathlib.Path) and not cache,
+            )
+        log.debug("input client %s", igit)
+
+        if store:
+            store.create()
+        targets = {}
+        for n, (subdir, output) in enumerate(projects):
+            if not igit.tree(subdir):
+                result[output] = f"no subdir {subdir} under {igit}"
+            elif subdir not in targets:
+                targets[subdir] = tmp / f"filtered-{n}.git"
+        head = igit.run(["rev-parse", "HEAD"])
+        with profiler.phase("fanout"):
+            filtered = fanout(igit, targets, dissociate=False)
+
+        import concurrent.futures
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for subdir, output in projects:
+                if output in result:
+                    continue
+                future = pool.submit(
+                    _extract_one,
+                    filtered[subdir].worktree,
+                    output,
+                    join_source(source, subdir),
+                    head,
+                    migrate,
+                    store and store.path,
+                )
+                futures[future] = output
+            for future in concurrent.futures.as_completed(futures):
+                result[futures[future]], phases = future.result()
+                profiler.phases.extend(phases)
+
+    for subdir, output in projects:
+        if result[output]:
+            log.error("failed %s -> %s: %s", subdir, output, result[output])
+        else:
+            log.info("extracted %s -> %s", subdir, output)
+    return result
+
+
+def discover(roots):
+    """returns the {output: mono2repo.uri} extracted repos under roots"""
+    result = {}
+    for root in roots:
+        for path, dirnames, _ in os.walk(root):
+            path = pathlib.Path(path).resolve()
+            if not (path / ".git").exists():
+                continue
+            # don't look into nested repos
+            dirnames[:] = []
+            uri = Git(path).config("mono2repo.uri", local=True)
+            if uri:
+                result[path] = uri
+    return result
+
+
+async def arun(args, limits=()):
+    """run for asyncio: returns the exit code and the (stdout+stderr) output"""
+    import asyncio
+
+    cmd = [str(c) for c in args]
+    async with contextlib.AsyncExitStack() as stack:
+        for limit in limits:
+            await stack.enter_async_context(limit)
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        )
+        out, _ = await process.communicate()
+        profiler.record(cmd, time.perf_counter() - start, process.returncode, len(out))
+    return process.returncode, out.decode("utf-8", errors="replace")
+
 
-    filter_repo_version = run(["git", "filter-repo", "--version"], False, True)
-    if not filter_repo_version:
-        options.error(
-            "missing filter-repo git plugin"
-            " (https://github.com/newren/git-filter-repo)"
+async def _update_source(source, outputs, cache, limit, per_source, command):
+    import asyncio
+
+    # a single fetch of the upstream, then all the outputs from the mirror
+    try:
+        async with limit:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, cache.mirror, source)
+    except Exception as exc:
+        log.debug("failed fetching %s", source, exc_info=True)
+        return {output: f"{exc.__class__.__name__}: {exc}" for output in outputs}
+
+    async def one(output):
+        # the per source slot first, not to hold a global one while waiting
+        code, txt = await arun([*command, output], limits=(per_source, limit))
+        if not code:
+            return output, None
+        log.debug("failed updating %s:\n%s", output, txt)
+        return output, txt.strip().split("\n")[-1] or f"exit code {code}"
+
+    return dict(await asyncio.gather(*(one(output) for output in outputs)))
+
+
+async def _update_all(sources, cache, workers, per_source, command):
+    import asyncio
+
+    limit = asyncio.Semaphore(workers or os.cpu_count() or 1)
+    tasks = [
+        _update_source(
+            source,
+            outputs,
+            cache,
+            limit,
+            asyncio.Semaphore(per_source or len(outputs)),
+            command,
         )
-    log.debug("filter-repo [%s]", filter_repo_version)
+        for source, outputs in sources.items()
+    ]
+    result = {}
+    for partial in await asyncio.gather(*tasks):
+        result.update(partial)
+    return result
+
+
+def update_all(
+    tmpdir,
+    roots,
+    migrate,
+    cache=None,
+    workers=None,
+    per_source=None,
+    backend="filter-repo",
+    verbose=False,
+    repack=None,
+):
+    """updates all the extracted repos found under roots
+
+    The outputs are grouped by upstream: each upstream is fetched once in
+    a mirror and its outputs are updated from it with a mono2repo update
+    subprocess each, at most workers at the same time (and per_source
+    from the same upstream), repack are the finalize arguments (if any).
+    Returns a {output: error message or None} dictionary.
+    """
+    with profiler.phase("discover"):
+        found = discover(roots)
+    if not found:
+        raise Mono2RepoError("no extracted repos found under", *roots)
+
+    result = {}
+    sources = {}
+    for output, uri in sorted(found.items()):
+        try:
+            source = split_source(uri)[0]
+        except (ValueError, Mono2RepoError) as exc:
+            result[output] = f"invalid mono2repo.uri {uri}: {exc}"
+            continue
+        sources.setdefault(str(source), []).append(output)
+
+    import asyncio
+
+    with tempdir(tmpdir) as tmp:
+        # the eviction runs at the end, not to drop mirrors still in use
+        mirrors = MirrorCache(cache.path if cache else tmp / "mirrors")
+        command = [
+            sys.executable,
+            pathlib.Path(__file__).resolve(),
+            "update",
+            *(["-v"] if verbose else []),
+            "--backend",
+            backend,
+            "--branch",
+            migrate,
+            "--cache",
+            mirrors.path,
+            "--no-fetch",
+        ]
+        if repack:
+            command += ["--finalize", "--repack-window", repack["window"]]
+            command += ["--repack-depth", repack["depth"]]
+            if repack["threads"]:
+                command += ["--repack-threads", repack["threads"]]
+        with profiler.phase("update-all"):
+            result.update(
+                asyncio.run(
+                    _update_all(sources, mirrors, workers, per_source, command)
+                )
+            )
+    if cache:
+        cache.evict(keep={cache.path / f"{cache.key(s)}.git" for s in sources})
+
+    for output, uri in sorted(found.items()):
+        if result[output]:
+            log.error("failed %s (%s): %s", output, uri, result[output])
+        else:
+            log.info("updated %s (%s)", output, uri)
+    return result
+
+
+def commit_map(output, sha):
+    """the (upstream, extracted) commit pairs matching sha in output"""
+    return CommitMap.of(Git(output)).lookup(sha)
+
+
+def maintain(path, prune="2.weeks.ago"):
+    """syncs the outputs of the path object store and gcs it"""
+    return ObjectStore(path).maintain(prune)
+
+
+# rough per unit costs in seconds (measured with support/benchmark.py)
+COSTS = {
+    "filter-repo": 150e-6,  # filter, per upstream commit
+    "native": 60e-6,  # filter, per upstream commit
+    "graft": 150e-6,  # fast-export | fast-import, per upstream commit
+    "rebase": 3e-3,  # per extracted commit
+    "replay": 2e-3,  # format-patch, am and rebase, per extracted commit
+}
+
+
+def inspect(git, subdir, revs):
+    """counts the commits (all, touching subdir and merges among these)
+    and the bytes (packed repo, objects under subdir) of git in revs
+    """
+    pathspec = ["--", subdir] if subdir else []
+
+    def count(*args):
+        return int(git.run(["rev-list", "--count", *args, *revs, *pathspec]))
+
+    result = {
+        "commits": int(git.run(["rev-list", "--count", *revs])),
+        "extracted": count(),
+        "merges": count("--merges"),
+    }
 
-    kwargs = {
-        n: getattr(options, n)
-        for n in {"tmpdir", "output", "func", "error", "uri", "migrate"}
+    result["size"] = git.size()
+
+    # the objects under subdir, sized by a single cat-file session
+    prefix = f"{subdir}/" if subdir else ""
+    oids = set()
+    for line in git.run_lines(["rev-list", "--objects", *revs, *pathspec]):
+        oid, _, path = line.partition(" ")
+        if path.startswith(prefix) and path != "":
+            oids.add(oid)
+    with git.session() as session:
+        infos = session.infos(sorted(oids))
+    result["subdir_size"] = sum(info[2] for info in infos if info)
+    return result
+
+
+def plan(
+    output,
+    uri=None,
+    migrate="migrate",
+    backend="filter-repo",
+    graft=False,
+    blobless=False,
+    cache=None,
+    sparse=False,
+):
+    """what init (with uri) or update would do on output, without doing it
+
+    The source is only read: a local one in place, a remote one through its
+    mirror in the cache (as it is, not refreshed) or else with a git
+    ls-remote (the counts and the clone duration are then unknown). Returns
+    a dictionary with the counts, the estimated phase durations (see COSTS)
+    and the commands init/update would run.
+    """
+    ogit = Git(pathlib.Path(output).resolve())
+    action = "init" if uri else "update"
+    last = None
+    if action == "init" and ogit.good():
+        raise Mono2RepoError("directory already initialized", ogit)
+    if action == "update":
+        if not ogit.good():
+            raise Mono2RepoError("directory not ready/present/initialized", ogit)
+        uri = ogit.config("mono2repo.uri", local=True)
+        if not uri:
+            raise Mono2RepoError("no mono2repo.uri config in", ogit)
+        last = ogit.config("mono2repo.last", local=True)
+    source, subdir = split_source(uri)
+
+    igit = None
+    mirror = cache.path / f"{cache.key(source)}.git" if cache else None
+    if mirror and mirror.exists():
+        igit = Git(mirror)
+    elif isinstance(source, pathlib.Path):
+        igit = Git(source)
+
+    result = {
+        "action": action,
+        "output": str(ogit.worktree),
+        "source": str(source),
+        "subdir": subdir,
+        "inspected": str(igit.worktree) if igit else None,
+        "last": last,
     }
-    with universe(**kwargs) as (ogit, igit, subdir):
-        options.func(igit, ogit, subdir, options.migrate)
+    for key in ["commits", "extracted", "merges", "size", "subdir_size"]:
+        result[key] = None
+    if igit:
+        head = igit.run(["rev-parse", "HEAD"])
+        ancestor = ["merge-base", "--is-ancestor", str(last), head]
+        if last and igit.run(ancestor, abort=False, silent=True) is None:
+            last = None
+        result.update(inspect(igit, subdir, [f"{last}..{head}"] if last else [head]))
+    else:
+        head = run(["git", "ls-remote", source, "HEAD"]).split()[0]
+    result["head"] = head
+
+    # estimates (the counts are relative to last for an incremental update)
+    phases = {}
+    if mirror and mirror.exists():
+        phases["clone"] = 0.0  # a local clone (plus the mirror refresh)
+    elif isinstance(source, pathlib.Path):
+        phases["clone"] = 0.0  # borrows the objects
+    if result["commits"] is not None:
+        commits, extracted = result["commits"], result["extracted"]
+        if last:
+            phases["graft" if graft else "replay"] = (
+                commits * COSTS["graft"] if graft else extracted * COSTS["replay"]
+            )
+        elif graft and action == "init" and backend == "native":
+            phases["graft"] = commits * COSTS["graft"]
+        else:
+            if subdir:
+                phases["filter"] = commits * COSTS[backend]
+            if graft and action == "init":
+                phases["graft"] = extracted * COSTS["graft"]
+            else:
+                phases["rebase"] = extracted * COSTS["rebase"]
+    result["phases"] = phases
+
+    # the commands (<tmpdir> being the temporary directory)
+    tmp = pathlib.Path("<tmpdir>")
+    legacy, filtered = tmp / "legacy-repo", tmp / "legacy-repo-filtered.git"
+    out = ogit.worktree
+
+    def git(path, *args):
+        return run(["git", "-C", path, *args], dryrun=True)
+
+    def pipe(src, dst, *revs):
+        return [*git(src, *FAST_EXPORT, *revs), "|", *git(dst, *FAST_IMPORT)]
+
+    commands = []
+    if cache:
+        if mirror.exists():
+            commands.append(git(mirror, "fetch", "--prune", "origin"))
+        else:
+            clone = ["git", "clone", "--bare", source, mirror]
+            commands.append(run(clone, dryrun=True))
+        args = Git.clone_args(mirror, legacy, not sparse, sparse=sparse and subdir)
+        commands.append(run(args, dryrun=True))
+    else:
+        shared = isinstance(source, pathlib.Path)
+        args = Git.clone_args(
+            source, legacy, not sparse, blobless, shared, sparse and subdir
+        )
+        commands.append(run(args, dryrun=True))
+    if sparse and subdir:
+        commands.append(git(legacy, *Git.sparse_args(subdir)))
+
+    keep = "--committer-date-is-author-date"
+    if last:
+        span = f"{last}..{head}"
+        if graft:
+            pathspec = ["--", subdir] if subdir else []
+            commands.append(pipe(legacy, out, span, *pathspec))
+        else:
+            relative = [f"--relative={subdir}", "--", subdir] if subdir else []
+            patch = ["format-patch", "-k", "-o", tmp, span, *relative]
+            commands.append(git(legacy, *patch))
+            commands.append(git(out, "am", "-k", keep, tmp / "*"))
+            commands.append(git(out, "rebase", keep, "master"))
+        commands.append(git(out, "config", "--local", "mono2repo.last", head))
+        result["commands"] = commands
+        return result
+
+    one_pass = graft and action == "init" and backend == "native"
+    if subdir and not one_pass:
+        if backend == "native":
+            commands.append(pipe(legacy, filtered, "HEAD"))
+            legacy = filtered
+        else:
+            commands.append(git(legacy, *filter_repo_args(subdir)))
+    pathspec = ["--", subdir] if subdir and one_pass else []
+
+    if action == "init":
+        if pathspec:
+            date = ["log", "--reverse", "--format=%cd", *pathspec]
+        else:
+            date = ["rev-list", "--max-parents=0", "--format=%cd", "HEAD"]
+        commands.append(git(legacy, *date))
+        commands.append(git(out, "init"))
+        commands.append(git(out, "checkout", "-b", "master"))
+        initial = ["--allow-empty", "-m", "Initial commit", "--date", "<date>"]
+        commands.append(git(out, "commit", *initial))
+    if graft and action == "init":
+        commands.append(pipe(legacy, out, "HEAD", *pathspec))
+    else:
+        remote = "legacy" if action == "init" else "legacy-repo"
+        commands.append(git(out, "remote", "add", remote, legacy))
+        commands.append(git(out, "fetch", remote, "master"))
+        checkout = "-b" if action == "init" else "-B"
+        track = ["--track", f"{remote}/master"]
+        commands.append(git(out, "checkout", checkout, migrate, *track))
+        commands.append(git(out, "rebase", keep, "master"))
+        commands.append(git(out, "remote", "remove", remote))
+        if action == "init":
+            commands.append(git(out, "repack", "-a", "-d", "-q"))
+            commands.append(git(out, "checkout", "master"))
+    commands.append(git(out, "config", "--local", "mono2repo.last", head))
+    if action == "init":
+        commands.append(git(out, "config", "--local", "mono2repo.uri", uri))
+    result["commands"] = commands
+    return result
+
+
+def print_plan(result):
+    def count(key):
+        return "unknown" if result[key] is None else result[key]
+
+    def size(key):
+        return "unknown" if result[key] is None else format_size(result[key])
+
+    print(f"plan      {result['action']} {result['output']}")
+    print(f"source    {result['source']} {result['subdir']} (HEAD {result['head']})")
+    if result["last"]:
+        print(f"since     {result['last']}")
+    print(f"inspected {result['inspected'] or 'nothing (remote, no mirror)'}")
+    print(
+        f"commits   {count('extracted')} to rewrite ({count('merges')} merges) "
+        f"out of {count('commits')}"
+    )
+    print(f"bytes     {size('size')} repository, {size('subdir_size')} under subdir")
+    phases = result["phases"]
+    txt = ", ".join(f"{name} {wall:.1f}s" for name, wall in phases.items())
+    print(f"estimate  {txt or 'unknown'} (total {sum(phases.values()):.1f}s)")
+    print("commands")
+    for cmd in result["commands"]:
+        print(f"  {shlex.join(cmd)}")
+
+
+def main(args=None):
+    options = parse_args(args)
+    profiler.reset()
+    try:
+        log.debug("found system %s", platform.uname().system.lower())
+        capabilities = Capabilities()
+        git_version = capabilities.git()
+        if not git_version:
+            options.error("missing git")
+        log.debug("git version [%s]", git_version)
+
+        if options.backend == "filter-repo":
+            filter_repo_version = capabilities.filter_repo()
+            if not filter_repo_version:
+                options.error(
+                    "missing filter-repo git plugin"
+                    " (https://github.com/newren/git-filter-repo),"
+                    " use --backend native for the built-in one"
+                )
+            log.debug("filter-repo [%s]", filter_repo_version)
+
+        if options.func == commit_map:
+            pairs = commit_map(options.output, options.sha)
+            if not pairs:
+                options.error(f"no commit {options.sha} in the {options.output} map")
+            for pair in pairs:
+                print(*pair)
+            return 0
+
+        if options.func == maintain:
+            if not options.store:
+                options.error("missing store (or MONO2REPO_STORE)")
+            try:
+                maintain(options.store, options.prune)
+            except Mono2RepoError as exc:
+                options.error(" ".join(str(a) for a in exc.args))
+            return 0
+
+        max_commits = getattr(options, "max_commits", None)
+        if max_commits is not None and max_commits < 1:
+            options.error("--max-commits must be a positive number")
+
+        if getattr(options, "blobless", False):
+            if options.backend != "native":
+                options.error("--blobless needs --backend native")
+            if options.cache:
+                options.error("--blobless cannot be used with --cache")
+
+        cache = None
+        if options.cache:
+            cache = MirrorCache(options.cache, options.cache_size)
+
+        repack = None
+        if getattr(options, "finalize", False):
+            repack = {
+                "window": options.repack_window,
+                "depth": options.repack_depth,
+                "threads": options.repack_threads,
+            }
+
+        if options.func == plan:
+            try:
+                result = plan(
+                    options.output,
+                    options.uri,
+                    options.migrate,
+                    backend=options.backend,
+                    graft=options.graft,
+                    blobless=options.blobless,
+                    cache=cache,
+                    sparse=options.sparse,
+                )
+            except (Mono2RepoError, ValueError) as exc:
+                options.error(" ".join(str(a) for a in exc.args))
+            print_plan(result)
+            return 0
+
+        if options.func == extract_many:
+            try:
+                result = extract_many(
+                    options.tmpdir,
+                    options.manifest,
+                    options.uri,
+                    options.migrate,
+                    cache=cache,
+                    workers=options.workers,
+                    blobless=options.blobless,
+                    store=options.store and ObjectStore(options.store),
+                )
+            except Mono2RepoError as exc:
+                options.error(" ".join(str(a) for a in exc.args))
+            return 1 if any(result.values()) else 0
+
+        if options.func == update_all:
+            try:
+                result = update_all(
+                    options.tmpdir,
+                    options.roots,
+                    options.migrate,
+                    cache=cache,
+                    workers=options.workers,
+                    per_source=options.per_source,
+                    backend=options.backend,
+                    verbose=options.verbose,
+                    repack=repack,
+                )
+            except Mono2RepoError as exc:
+                options.error(" ".join(str(a) for a in exc.args))
+            return 1 if any(result.values()) else 0
+
+        if not getattr(options, "fetch", True) and not cache:
+            options.error("--no-fetch needs a --cache")
+        if options.refs and getattr(options, "filter_cache", None):
+            # the cached histories are keyed by the upstream HEAD only
+            options.error("--refs cannot be used with --filter-cache")
+        bounds = ["since", "since_ref", "max_commits"]
+        if any(getattr(options, n, None) for n in bounds) and getattr(
+            options, "filter_cache", None
+        ):
+            # a cached history has no upstream commits to bound
+            options.error(
+                "--since, --since-ref and --max-commits"
+                " cannot be used with --filter-cache"
+            )
+
+        kwargs = {
+            n: getattr(options, n)
+            for n in {"tmpdir", "output", "func", "error", "uri", "migrate"}
+        }
+        extra = {}
+        if getattr(options, "filter_cache", None):
+            age = options.filter_cache_age
+            extra["filters"] = FilterCache(
+                options.filter_cache,
+                options.filter_cache_size,
+                None if age is None else age * 24 * 3600,
+            )
+        kwargs["fetch"] = getattr(options, "fetch", True)
+        kwargs["blobless"] = options.blobless
+        kwargs["sparse"] = options.sparse
+        only = {}  # the init only arguments
+        if options.func == init:
+            only = {
+                "since": options.since,
+                "since_ref": options.since_ref,
+                "max_commits": options.max_commits,
+                "store": options.store and ObjectStore(options.store),
+            }
+            # the older history isn't even downloaded (from a remote)
+            if options.since or options.since_ref:
+                kwargs["shallow"] = {
+                    "since": options.since,
+                    "since_ref": options.since_ref,
+                }
+        kwargs["graft"] = options.graft
+        kwargs["backend"] = options.backend
+        try:
+            with universe(**kwargs, **extra, cache=cache) as (ogit, igit, subdir):
+                options.func(
+                    igit,
+                    ogit,
+                    subdir,
+                    options.migrate,
+                    backend=options.backend,
+                    graft=options.graft,
+                    refs=options.refs or (),
+                    workers=options.workers,
+                    **extra,
+                    **only,
+                )
+                if repack:
+                    finalize(ogit, **repack)
+        except Mono2RepoError as exc:
+            options.error(" ".join(str(a) for a in exc.args))
+    finally:
+        if options.profile:
+            log.debug("writing profile report to %s", options.profile)
+            profiler.dump(options.profile)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""generate synthetic monorepos and time mono2repo init/update on them
+
+Eg.
+    python support/benchmark.py --sizes 1000,10000,100000 -o results.json
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "src"))
+from mono2repo import mono2repo  # noqa: E402
+
+
+class Shape:
+    """the synthetic monorepo shape"""
+
+    def __init__(
+        self,
+        commits=1000,
+        files_per_commit=3,
+        projects=10,
+        blob_size=256,
+        binary_ratio=0.05,
+        binary_size=64 * 1024,
+        merge_density=0.05,
+        seed=0,
+    ):
+        self.commits = commits
+        self.files_per_commit = files_per_commit
+        self.projects = projects
+        self.blob_size = blob_size
+        self.binary_ratio = binary_ratio
+        self.binary_size = binary_size
+        self.merge_density = merge_density
+        self.seed = seed
+
+
+class Generator:
+    """writes a synthetic history into a git repo with fast-import
+
+    The commits touch files under projects/pNN (and a shared common/ dir),
+    a fraction (merge_density) of them is done in a side branch and merged
+    back into master.
+    """
+
+    def __init__(self, path, shape):
+        self.path = path
+        self.shape = shape
+        self.random = random.Random(shape.seed)
+        self.mark = 0
+        self.tick = 1_500_000_000
+        self.master = None  # the branches tip marks
+        self.side = None
+        self.side_changes = []
+
+    def project(self, n=None):
+        n = self.random.randrange(self.shape.projects) if n is None else n
+        return f"projects/p{n:02d}"
+
+    def blob(self, out):
+        if self.random.random() < self.shape.binary_ratio:
+            data = self.random.randbytes(self.shape.binary_size)
+        else:
+            line = f"{self.mark} {self.random.random()}\n".encode()
+            data = (line * (self.shape.blob_size // len(line) + 1))[
+                : self.shape.blob_size
+            ]
+        self.mark += 1
+        out.append(b"blob\nmark :%i\ndata %i\n%s\n" % (self.mark, len(data), data))
+        return self.mark
+
+    def commit(self, out, ref, parents, changes, message):
+        self.mark += 1
+        self.tick += 60
+        message_data = message.encode()
+        out.append(b"commit %s\nmark :%i\n" % (ref, self.mark))
+        for who in (b"author A U Thor <author", b"committer C O Mitter <committer"):
+            out.append(b"%s@example.com> %i +0000\n" % (who, self.tick))
+        out.append(b"data %i\n%s\n" % (len(message_data), message_data))
+        if parents:
+            out.append(b"from :%i\n" % parents[0])
+            out.extend(b"merge :%i\n" % p for p in parents[1:])
+        out.extend(changes)
+        out.append(b"\n")
+        return self.mark
+
+    def changes(self, out, side=False):
+        result = []
+        for _ in range(self.shape.files_per_commit):
+            base = self.project() if self.random.random() > 0.1 else "common"
+            name = f"{'side/' if side else ''}f{self.random.randrange(20)}"
+            path = f"{base}/{name}".encode()
+            result.append(b"M 100644 :%i %s\n" % (self.blob(out), path))
+        return result
+
+    def step(self, out, n):
+        density = self.shape.merge_density
+        if self.side is not None and self.random.random() < density:
+            # merge the side branch back (its changes relative to master)
+            self.master = self.commit(
+                out,
+                b"refs/heads/master",
+                [self.master, self.side],
+                self.side_changes,
+                f"merge side at {n}",
+            )
+            self.side, self.side_changes = None, []
+        elif self.master is not None and self.random.random() < density:
+            changes = self.changes(out, side=True)
+            self.side = self.commit(
+                out,
+                b"refs/heads/side",
+                [self.side or self.master],
+                changes,
+                f"side commit {n}",
+            )
+            self.side_changes.extend(changes)
+        else:
+            changes = self.changes(out)
+            parents = [self.master] if self.master else []
+            self.master = self.commit(
+                out, b"refs/heads/master", parents, changes, f"commit {n}"
+            )
+
+    def generate(self, commits=None, start=0):
+        # marks survive across runs, so append() can refer to older commits
+        marks = self.path / ".git" / "benchmark-marks"
+        process = subprocess.Popen(
+            [
+                "git",
+                "-C",
+                str(self.path),
+                "fast-import",
+                "--quiet",
+                "--force",
+                f"--import-marks-if-exists={marks}",
+                f"--export-marks={marks}",
+            ],
+            stdin=subprocess.PIPE,
+        )
+        for n in range(start, start + (commits or self.shape.commits)):
+            out = []
+            self.step(out, n)
+            process.stdin.write(b"".join(out))
+        process.stdin.close()
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    def create(self):
+        subprocess.check_call(["git", "init", "-q", "-b", "master", str(self.path)])
+        self.generate()
+        subprocess.check_call(["git", "-C", str(self.path), "checkout", "-q", "-f"])
+        return self.path
+
+    def append(self, commits):
+        # new commits on top of the current master (eg. for update)
+        self.generate(commits, start=self.shape.commits)
+        subprocess.check_call(
+            ["git", "-C", str(self.path), "reset", "-q", "--hard", "master"]
+        )
+        return self.path
+
+
+def timed(action, args, profile):
+    start = time.perf_counter()
+    mono2repo.main([action, "--profile", profile, *args])
+    wall = time.perf_counter() - start
+    phases = {}
+    for phase in json.loads(profile.read_text())["phases"]:
+        phases[phase["name"]] = phases.get(phase["name"], 0.0) + phase["wall"]
+    return {"action": action, "wall": wall, "phases": phases}
+
+
+def benchmark(workdir, shape, options):
+    results = []
+    generator = Generator(workdir / "monorepo", shape)
+
+    start = time.perf_counter()
+    generator.create()
+    generated = time.perf_counter() - start
+
+    output = workdir / "output"
+    uri = generator.path / generator.project(0)
+    extra = ["--backend", options.backend]
+    init_extra = ["--graft"] if options.graft else []
+    results.append(
+        timed("init", [*extra, *init_extra, output, uri], workdir / "init.json")
+    )
+
+    generator.append(options.update_commits)
+    mono2repo.Git(output).run(["merge", "-q", "migrate"])
+    results.append(timed("update", [*extra, output], workdir / "update.json"))
+
+    for result in results:
+        result.update(
+            {
+                "commits": shape.commits,
+                "generate": generated,
+                "shape": dict(vars(shape)),
+            }
+        )
+    return results
+
+
+def parse_args(args=None):
+    if isinstance(args, (list, tuple, None.__class__)):
+        args = None if args is None else [str(a) for a in args]
+    else:
+        return args
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__
+    )
+    defaults = Shape()
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="comma separated commit counts",
+    )
+    parser.add_argument(
+        "--files-per-commit", type=int, default=defaults.files_per_commit
+    )
+    parser.add_argument("--projects", type=int, default=defaults.projects)
+    parser.add_argument("--blob-size", type=int, default=defaults.blob_size)
+    parser.add_argument("--binary-ratio", type=float, default=defaults.binary_ratio)
+    parser.add_argument("--binary-size", type=int, default=defaults.binary_size)
+    parser.add_argument("--merge-density", type=float, default=defaults.merge_density)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--update-commits", type=int, default=10)
+    parser.add_argument("--backend", choices=mono2repo.BACKENDS, default="native")
+    parser.add_argument("--graft", action="store_true")
+    parser.add_argument("--workdir", type=pathlib.Path, help="keep the repos here")
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="json results file")
+    options = parser.parse_args(args)
+    options.error = parser.error
+    try:
+        options.sizes = [int(s) for s in options.sizes.split(",")]
+    except ValueError:
+        parser.error(f"invalid --sizes {options.sizes}")
+    return options
+
+
+def main(args=None):
+    options = parse_args(args)
+
+    # generated commits carry their own identities, the initial/rebased ones not
+    for key, value in {
+        "GIT_AUTHOR_NAME": "mono2repo benchmark",
+        "GIT_AUTHOR_EMAIL": "benchmark@example.com",
+        "GIT_COMMITTER_NAME": "mono2repo benchmark",
+        "GIT_COMMITTER_EMAIL": "benchmark@example.com",
+    }.items():
+        os.environ.setdefault(key, value)
+
+    results = []
+    for size in options.sizes:
+        shape = Shape(
+            commits=size,
+            files_per_commit=options.files_per_commit,
+            projects=options.projects,
+            blob_size=options.blob_size,
+            binary_ratio=options.binary_ratio,
+            binary_size=options.binary_size,
+            merge_density=options.merge_density,
+            seed=options.seed,
+        )
+        workdir = pathlib.Path(
+            tempfile.mkdtemp(dir=options.workdir, prefix=f"bench-{size}-")
+        )
+        try:
+            results.extend(benchmark(workdir, shape, options))
+        finally:
+            if not options.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    txt = json.dumps(results, indent=2)
+    if options.output:
+        options.output.write_text(txt)
+    else:
+        print(txt)
+    return results
+
+
+if __name__ == "__main__":
+    main()
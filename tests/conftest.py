@@ -5,6 +5,7 @@ import pathlib
 import shutil
 import subprocess
 import sys
+import types
 
 import pytest
 
@@ -114,3 +115,82 @@ def pytest_collection_modifyitems(config, items):
         if "manual" not in item.keywords:
             continue
         item.add_marker(pytest.mark.skip(reason="manual not selected"))
+
+
+@pytest.fixture()
+def gitenv(monkeypatch, tmp_path_factory):
+    """isolates git (and the mono2repo cache dir) from the user configuration"""
+    for key, value in {
+        "XDG_CACHE_HOME": str(tmp_path_factory.mktemp("cache")),
+        "GIT_AUTHOR_NAME": "A U Thor",
+        "GIT_AUTHOR_EMAIL": "author@example.com",
+        "GIT_COMMITTER_NAME": "C O Mitter",
+        "GIT_COMMITTER_EMAIL": "committer@example.com",
+        "GIT_CONFIG_NOSYSTEM": "1",
+        "GIT_CONFIG_GLOBAL": os.devnull,
+    }.items():
+        monkeypatch.setenv(key, value)
+
+
+@pytest.fixture()
+def monorepo(tmp_path, gitenv):
+    """a small monorepo (the README.rst layout) with a linear history
+
+    monorepo/
+    ├── README.TXT
+    ├── misc
+    │   └── more
+    └── subfolder
+        ├── project1
+        │   └── a
+        │       ├── hello.txt
+        │       └── subtree
+        └── project2
+            └── world.txt
+    """
+    path = tmp_path / "monorepo"
+
+    def git(*args):
+        return subprocess.check_output(
+            ["git", "-C", str(path), *[str(a) for a in args]], encoding="utf-8"
+        ).strip()
+
+    def commit(message, files, date):
+        for name, content in files.items():
+            (path / name).parent.mkdir(parents=True, exist_ok=True)
+            (path / name).write_text(content)
+        git("add", ".")
+        git(
+            "-c",
+            "core.hooksPath=/dev/null",
+            "commit",
+            "-q",
+            "-m",
+            message,
+            "--date",
+            date,
+        )
+
+    path.mkdir()
+    git("init", "-q", "-b", "master")
+    commit("first", {"README.TXT": "hello\n"}, "2020-01-01T10:00:00")
+    commit(
+        "add project1",
+        {"subfolder/project1/a/hello.txt": "hello\n"},
+        "2020-01-02T10:00:00",
+    )
+    commit("add misc", {"misc/more": "more\n"}, "2020-01-03T10:00:00")
+    commit(
+        "add project2",
+        {"subfolder/project2/world.txt": "world\n"},
+        "2020-01-04T10:00:00",
+    )
+    commit(
+        "update project1",
+        {
+            "subfolder/project1/a/hello.txt": "hello world\n",
+            "subfolder/project1/a/subtree": "subtree\n",
+        },
+        "2020-01-05T10:00:00",
+    )
+    return types.SimpleNamespace(path=path, git=git, commit=commit)
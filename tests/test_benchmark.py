@@ -0,0 +1,43 @@
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+
+@pytest.fixture()
+def benchmark(monkeypatch):
+    path = pathlib.Path(__file__).parent.parent / "support/benchmark.py"
+    spec = importlib.util.spec_from_file_location("benchmark", path)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, spec.name, module)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_benchmark(benchmark, gitenv, tmp_path):
+    args = "--sizes 20,30 --update-commits 3 --merge-density 0.3".split()
+    results = benchmark.main(
+        [*args, "--workdir", tmp_path, "-o", tmp_path / "results.json"]
+    )
+    expected = [(n, action) for n in (20, 30) for action in ("init", "update")]
+    assert [(r["commits"], r["action"]) for r in results] == expected
+    for result in results:
+        assert {"clone", "cleanup"} < set(result["phases"])
+    assert (tmp_path / "results.json").exists()
+
+    # the generator is deterministic for a given seed
+    logs = [
+        benchmark.subprocess.check_output(
+            ["git", "-C", str(path / "monorepo"), "log", "--format=%T"]
+        )
+        for path in sorted(tmp_path.glob("bench-20-*"))
+    ]
+    repo = tmp_path / "again"
+    benchmark.Generator(repo, benchmark.Shape(commits=20, merge_density=0.3)).create()
+    assert (
+        logs[0].split()[-20:]
+        == benchmark.subprocess.check_output(
+            ["git", "-C", str(repo), "log", "--format=%T"]
+        ).split()
+    )
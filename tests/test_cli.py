@@ -15,11 +15,13 @@ PNAME = pathlib.Path(sys.argv[0]).name
 def test_parse_no_args(capsys):
     pytest.raises(SystemExit, mono2repo.parse_args, [])
     expected = f"""
-usage: {PNAME} [-h] [--version] {{init,update}} ...
+usage: {PNAME} [-h] [--version]
+    {{init,update,plan,update-all,extract-many,map,maintain}} ...
 {PNAME}: error: the following arguments are required: action
 """.lstrip()
     captured = capsys.readouterr()
-    assert captured.err == expected
+    # argparse wraps the usage line depending on the program name length
+    assert captured.err.split() == expected.split()
 
 
 def test_parse_help_args(capsys):
@@ -32,7 +34,8 @@ def test_parse_help_args(capsys):
         fixes["optional arguments"] = "options"
 
     expected = f"""
-usage: {PNAME} [-h] [--version] {{init,update}} ...
+usage: {PNAME} [-h] [--version]
+    {{init,update,plan,update-all,extract-many,map,maintain}} ...
 
 Create a new git checkout from a git repo.
 
@@ -41,7 +44,7 @@ Create a new git checkout from a git repo.
   --version      show program's version number and exit
 
 actions:
-  {{init,update}}
+  {{init,update,plan,update-all,extract-many,map,maintain}}
 
 Eg.
     mono2repo init summary-extracted \\
@@ -49,15 +52,26 @@ Eg.
 
     mono2repo update summary-extracted
 """.strip()
-    assert capsys.readouterr().out.strip() == expected
+    # the help columns width depends on the actions list
+    assert capsys.readouterr().out.split() == expected.split()
 
 
 def test_parse_invalid_init_args(capsys):
     args = ["init"]
     pytest.raises(SystemExit, mono2repo.parse_args, args)
     expected = f"""
-usage: {PNAME} init [-h] [-v] [--tmpdir TMPDIR] [--branch MIGRATE] output uri
+usage: {PNAME} init [-h] [-v] [--tmpdir TMPDIR] [--profile PROFILE] [--cache CACHE]
+    [--cache-size CACHE_SIZE] [--branch MIGRATE]
+    [--backend {{filter-repo,native}}] [--blobless] [--sparse]
+    [--refs GLOB] [-j WORKERS] [--finalize]
+    [--repack-window REPACK_WINDOW] [--repack-depth REPACK_DEPTH]
+    [--repack-threads REPACK_THREADS] [--store STORE] [--graft]
+    [--filter-cache FILTER_CACHE]
+    [--filter-cache-size FILTER_CACHE_SIZE]
+    [--filter-cache-age FILTER_CACHE_AGE] [--since SINCE] [--since-ref SINCE_REF]
+    [--max-commits MAX_COMMITS] output uri
 {PNAME} init: error: the following arguments are required: output, uri
 """.strip()
 
-    assert capsys.readouterr().err.strip() == expected
+    # argparse wraps the usage line depending on the program name length
+    assert capsys.readouterr().err.split() == expected.split()
@@ -1,9 +1,26 @@
+import json
+import os
 import pathlib
+import shutil
+import subprocess
 
 import pytest
 
 from mono2repo import mono2repo
 
+# the filter-repo backend needs the git filter-repo plugin
+filter_repo = pytest.mark.skipif(
+    not mono2repo.run(["git", "filter-repo", "--version"], False, True),
+    reason="missing git filter-repo",
+)
+BACKENDS = ["native", pytest.param("filter-repo", marks=filter_repo)]
+# the backend and --graft combinations
+GRAFTS = [
+    ("native", False),
+    ("native", True),
+    pytest.param("filter-repo", False, marks=filter_repo),
+]
+
 
 @pytest.fixture(scope="function")
 def myfs(tmp_path):
@@ -19,9 +36,54 @@ def test_platform(platform):
 
 def test_which(platform):
     if platform == "windows":
-        assert mono2repo.which("CMD.EXE") == r"C:\Windows\System32\cmd.exe"
+        assert mono2repo.which("CMD.EXE").lower() == r"c:\windows\system32\cmd.exe"
     else:
         assert mono2repo.which("ls") in {"/bin/ls", "/usr/bin/ls"}
+    pytest.raises(FileNotFoundError, mono2repo.which, "no-such-executable")
+
+
+def test_capabilities(tmp_path, gitenv, monkeypatch):
+    assert mono2repo.cache_home().parent == pathlib.Path(os.getenv("XDG_CACHE_HOME"))
+
+    tool = tmp_path / "bin" / "tool"
+    tool.parent.mkdir()
+    tool.write_text("#!/bin/sh\necho tool 1.0\n")
+    tool.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tool.parent), prepend=os.pathsep)
+
+    capabilities = mono2repo.Capabilities(tmp_path / "caps.json")
+    mono2repo.profiler.reset()
+    assert capabilities.probe("tool", [tool], ["tool"]) == "tool 1.0"
+    assert capabilities.probe("tool", [tool], ["tool"]) == "tool 1.0"
+    assert len(mono2repo.profiler.phases[-1]["commands"]) == 1
+
+    # a changed binary is probed again
+    tool.write_text("#!/bin/sh\necho tool 2.0\n")
+    os.utime(tool, ns=(0, 0))
+    assert capabilities.probe("tool", [tool], ["tool"]) == "tool 2.0"
+    assert len(mono2repo.profiler.phases[-1]["commands"]) == 2
+
+    # failures aren't cached
+    assert capabilities.probe("none", ["false"], ["false"]) is None
+    assert "none" not in json.loads(capabilities.path.read_text())
+
+    # the symlinks are keyed by their target
+    (tool.parent / "link").symlink_to(tool)
+    assert capabilities.stamp("link") == capabilities.stamp(tool)
+
+    # a plugin in the git exec path
+    plugin = tmp_path / "exec" / "git-filter-repo"
+    plugin.parent.mkdir()
+    plugin.write_text("#!/bin/sh\necho filter-repo 1.0\n")
+    plugin.chmod(0o755)
+    monkeypatch.setenv("GIT_EXEC_PATH", str(plugin.parent))
+    assert capabilities.filter_repo() == "filter-repo 1.0"
+    plugin.write_text("#!/bin/sh\necho filter-repo 2.0\n")
+    os.utime(plugin, ns=(0, 0))
+    assert capabilities.filter_repo() == "filter-repo 2.0"
+    monkeypatch.delenv("GIT_EXEC_PATH")
+
+    assert mono2repo.Capabilities().git().startswith("git version")
 
 
 @pytest.mark.parametrize(
@@ -61,3 +123,1187 @@ def test_findroot(myfs):
         assert (expected, "") == mono2repo.Git.findroot(".")
     finally:
         os.chdir(cdir)
+
+
+@pytest.mark.parametrize(
+    "txt, expected",
+    [
+        (None, None),
+        ("100", 100),
+        ("2k", 2048),
+        ("1.5M", 1572864),
+        ("10G", 10 * 1024**3),
+        ("3GiB", 3 * 1024**3),
+        ("boo", ValueError()),
+    ],
+)
+def test_parse_size(txt, expected):
+    if isinstance(expected, Exception):
+        pytest.raises(expected.__class__, mono2repo.parse_size, txt)
+    else:
+        assert mono2repo.parse_size(txt) == expected
+
+
+def test_run_lines(monorepo):
+    git = mono2repo.Git(monorepo.path)
+    lines = git.run_lines(["log", "--format=%s"])
+    assert next(lines) == "update project1"
+    # stopping early terminates the command
+    lines.close()
+    commands = mono2repo.profiler.phases[-1]["commands"]
+    assert commands[-1]["cmd"][-2:] == ["log", "--format=%s"]
+
+    assert list(git.run_lines(["log", "--reverse", "--format=%s"]))[:2] == [
+        "first",
+        "add project1",
+    ]
+    with pytest.raises(subprocess.CalledProcessError):
+        list(git.run_lines(["log", "no-such-ref"], silent=True))
+
+    first = monorepo.git("log", "-1", "--format=%cd", "HEAD~4")
+    assert mono2repo.first_date(git) == first
+    assert mono2repo.first_date(git, ["--", "subfolder/project2"]) == monorepo.git(
+        "log", "-1", "--format=%cd", "HEAD~1"
+    )
+
+
+def test_git_state(tmp_path, monorepo, monkeypatch):
+    monkeypatch.setattr(mono2repo.Git, "READER", "cli")
+    mono2repo.profiler.reset()
+    git = mono2repo.Git(monorepo.path)
+    assert "branch=undef" in repr(git)
+    assert not mono2repo.profiler.phases
+
+    assert git.good() and git.branch == "master"
+    assert git.good() and git.branch == "master"
+    assert "branch=master" in repr(git)
+    commands = mono2repo.profiler.phases[-1]["commands"]
+    assert [c["cmd"][3:] for c in commands] == [
+        ["rev-parse", "--git-dir"],
+        ["branch", "--show-current"],
+    ]
+
+    # mono2repo own checkouts drop the cached state
+    git.run(["checkout", "-q", "-b", "other"])
+    assert git.branch == "other"
+    git.branch = "master"
+    assert git.branch == "master"
+
+    # bare repos are good too
+    bare = mono2repo.Git.clone(monorepo.path, tmp_path / "bare", bare=True)
+    assert bare.good() and bare.branch == "master"
+    assert not mono2repo.Git(tmp_path / "missing").good()
+
+
+@pytest.mark.parametrize("name", ["cli", "pygit2", "dulwich"])
+def test_reader(tmp_path, monorepo, name):
+    if name != "cli":
+        pytest.importorskip(name)
+    git = mono2repo.Git(monorepo.path)
+    reader = mono2repo.reader(git, name)
+    assert reader.name == name
+
+    assert reader.good() and reader.branch() == "master"
+    assert not mono2repo.reader(mono2repo.Git(tmp_path / "missing"), name).good()
+    monorepo.git("config", "--local", "mono2repo.uri", "a/b.git")
+    assert reader.config("mono2repo.uri", local=True) == "a/b.git"
+    assert reader.config("mono2repo.none") is None
+    assert not reader.dirty()
+    (monorepo.path / "new.txt").write_text("new\n")
+    assert reader.dirty()
+
+    assert reader.first_date() == monorepo.git("log", "-1", "--format=%cd", "HEAD~4")
+    assert reader.first_date(["--", "subfolder/project2"]) == monorepo.git(
+        "log", "-1", "--format=%cd", "HEAD~1"
+    )
+
+
+def test_reader_fallback(monorepo):
+    git = mono2repo.Git(monorepo.path)
+    assert type(mono2repo.reader(git, "no-such-library")) is mono2repo.Reader
+    assert mono2repo.reader(git).available()
+
+    # the library dates match git ones
+    for spec in ["HEAD", "HEAD~4"]:
+        timestamp, date = monorepo.git("log", "-1", "--format=%ct %cI", spec).split()
+        sign = -1 if date[-6] == "-" else 1
+        offset = sign * (int(date[-5:-3]) * 60 + int(date[-2:]))
+        assert mono2repo.format_date(int(timestamp), offset) == monorepo.git(
+            "log", "-1", "--format=%cd", spec
+        )
+    assert mono2repo.format_date(0, -90) == "Wed Dec 31 22:30:00 1969 -0130"
+
+
+def test_mirror_cache(tmp_path, monorepo):
+    cache = mono2repo.MirrorCache(tmp_path / "cache")
+
+    mirror = cache.mirror(monorepo.path)
+    assert mirror.worktree.parent == cache.path
+    assert mirror.run(["rev-parse", "--is-bare-repository"]) == "true"
+    assert mirror.run(["rev-parse", "master"]) == monorepo.git("rev-parse", "HEAD")
+
+    # new upstream commits land with an incremental fetch
+    monorepo.commit("more", {"misc/more": "even more\n"}, "2020-02-01T10:00:00")
+    assert cache.mirror(monorepo.path).worktree == mirror.worktree
+    assert mirror.run(["rev-parse", "master"]) == monorepo.git("rev-parse", "HEAD")
+
+    igit = mono2repo.Git.clone(monorepo.path, tmp_path / "legacy-repo", cache=cache)
+    assert (igit.worktree / "subfolder/project1/a/hello.txt").exists()
+
+
+def test_mirror_cache_evict(tmp_path, monorepo):
+    cache = mono2repo.MirrorCache(tmp_path / "cache")
+    first = cache.mirror(monorepo.path).worktree
+    second = cache.mirror(f"{monorepo.path}/.git").worktree
+    assert [p for p, _, _ in cache.entries()] == [first, second]
+
+    # the cap forces out the least recently used mirror, never the current one
+    cache.maxsize = 1
+    assert cache.mirror(monorepo.path).worktree == first
+    assert not second.exists()
+    assert [p for p, _, _ in cache.entries()] == [first]
+
+
+def test_mirror_cache_lock(tmp_path, monorepo, monkeypatch, platform):
+    cache = mono2repo.MirrorCache(tmp_path / "cache", maxsize=1)
+    first = cache.mirror(monorepo.path).worktree
+
+    # a mirror in use (locked by another process) is not evicted
+    if platform != "windows":
+        with cache.lock(first) as locked:
+            assert locked
+            with cache.lock(first, block=False) as other:
+                assert not other
+            second = cache.mirror(f"{monorepo.path}/.git").worktree
+            assert first.exists()
+        assert cache.evict(keep={second}) == [first]
+
+        # many readers at the same time, none can refresh meanwhile
+        with cache.use(monorepo.path) as mirror:
+            with cache.use(monorepo.path, fetch=False) as other:
+                assert other.worktree == mirror.worktree == first
+                with cache.lock(first, block=False) as locked:
+                    assert not locked
+                with cache.lock(first, shared=True, block=False) as locked:
+                    assert locked
+
+    # another process winning the creation race: its mirror is used
+    uri = f"file://{monorepo.path}"
+    path = cache.path / f"{cache.key(uri)}.git"
+    run = mono2repo.run
+
+    def racing(args, *rest, **kwargs):
+        if args[:3] == ["git", "clone", "--bare"] and not path.exists():
+            run([*args[:-1], path])
+        return run(args, *rest, **kwargs)
+
+    monkeypatch.setattr(mono2repo, "run", racing)
+    assert cache.mirror(uri).worktree == path
+    assert not list(cache.path.glob("*.tmp"))
+
+
+def test_update_incremental(tmp_path, monorepo):
+    igit = mono2repo.Git(monorepo.path)
+    last = igit.run(["rev-parse", "HEAD"])
+
+    # an output matching the upstream project1 at last
+    ogit = mono2repo.Git(tmp_path / "output")
+    ogit.init("master")
+    (ogit.worktree / "a").mkdir()
+    (ogit.worktree / "a/hello.txt").write_text("hello world\n")
+    (ogit.worktree / "a/subtree").write_text("subtree\n")
+    ogit.run(["add", "."])
+    ogit.run(["commit", "-m", "extracted"])
+    ogit.run(["checkout", "-b", "migrate"])
+    ogit.run(["config", "--local", "mono2repo.last", last])
+
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/new.txt": "new\n"},
+        "2020-02-01T10:00:00",
+    )
+    monorepo.commit("misc change", {"misc/more": "other\n"}, "2020-02-02T10:00:00")
+    head = igit.run(["rev-parse", "HEAD"])
+
+    mono2repo.update(igit, ogit, "subfolder/project1", "migrate")
+
+    assert ogit.run(["log", "--format=%s"]).split("\n") == [
+        "project1 change",
+        "extracted",
+    ]
+    assert ogit.run(["log", "-1", "--format=%ad"]) == ogit.run(
+        ["log", "-1", "--format=%cd"]
+    )
+    assert (ogit.worktree / "a/new.txt").read_text() == "new\n"
+    assert ogit.run(["config", "--local", "mono2repo.last"]) == head
+
+
+def test_parse_manifest(tmp_path):
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text(
+        """
+# project list
+subfolder/project1/  out/project1
+subfolder/project2   out/project2  # trailing comment
+"""
+    )
+    assert mono2repo.parse_manifest(manifest) == [
+        ("subfolder/project1", pathlib.Path("out/project1").resolve()),
+        ("subfolder/project2", pathlib.Path("out/project2").resolve()),
+    ]
+
+    manifest.write_text("subfolder/project1\n")
+    pytest.raises(mono2repo.Mono2RepoError, mono2repo.parse_manifest, manifest)
+
+    manifest.write_text("subfolder/project1 out\nsubfolder/project2 out\n")
+    pytest.raises(mono2repo.Mono2RepoError, mono2repo.parse_manifest, manifest)
+
+
+def test_extract_many_reports_failures(tmp_path, monorepo):
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text(
+        f"""
+subfolder/project1 {tmp_path / "project1"}
+subfolder/missing  {tmp_path / "missing"}
+"""
+    )
+    result = mono2repo.extract_many(
+        tmp_path / "tmp", manifest, str(monorepo.path), "migrate", workers=2
+    )
+    assert set(result) == {tmp_path / "project1", tmp_path / "missing"}
+    assert result[tmp_path / "missing"].startswith("no subdir subfolder/missing")
+    assert result[tmp_path / "project1"] is None
+
+    ogit = mono2repo.Git(tmp_path / "project1")
+    assert ogit.branch == "master"
+    assert ogit.run(["show", "migrate:a/hello.txt"]) == "hello world"
+    assert ogit.run(["log", "--format=%s", "migrate"]).split("\n") == [
+        "update project1",
+        "add project1",
+        "Initial commit",
+    ]
+    assert ogit.run(["config", "mono2repo.last"]) == monorepo.git("rev-parse", "HEAD")
+
+
+def test_extract_many_no_subdirs(tmp_path, monorepo, monkeypatch):
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text(f"subfolder/missing {tmp_path / 'missing'}\n")
+
+    def stream(*args, **kwargs):
+        raise AssertionError("unexpected fast-export")
+
+    monkeypatch.setattr(mono2repo, "stream", stream)
+    result = mono2repo.extract_many(
+        tmp_path / "tmp", manifest, str(monorepo.path), "migrate"
+    )
+    assert list(result) == [tmp_path / "missing"]
+    assert result[tmp_path / "missing"].startswith("no subdir subfolder/missing")
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        (b"a/b.txt", b"a/b.txt"),
+        (b'"a/\\303\\251\\"x\\\\y\\n"', b'a/\xc3\xa9"x\\y\n'),
+    ],
+)
+def test_quote_path(path, expected):
+    assert mono2repo.unquote_path(path) == expected
+    assert mono2repo.unquote_path(mono2repo.quote_path(expected)) == expected
+
+
+def test_cat_file(monorepo):
+    git = mono2repo.Git(monorepo.path)
+    mono2repo.profiler.reset()
+    with git.session() as session:
+        head = monorepo.git("rev-parse", "HEAD")
+        assert session.info("HEAD") == (head, "commit", len(session.read(head)[2]))
+        assert session.info("HEAD:no such path") is None
+        assert session.read("HEAD:README.TXT") == (
+            monorepo.git("rev-parse", "HEAD:README.TXT"),
+            "blob",
+            b"hello\n",
+        )
+        # pipelined, answers in the requests order
+        specs = [f"HEAD~{n}" for n in range(5)] * 200
+        assert [i[0] for i in session.infos(specs)] == [
+            monorepo.git("rev-parse", spec) for spec in specs[:5]
+        ] * 200
+
+        # the trees are walked with the session, as ls-tree -r would
+        flt = mono2repo.SubdirFilter("subfolder/project1", git)
+        expected = [(b"deleteall",)]
+        txt = monorepo.git("ls-tree", "-r", head, "subfolder/project1/")
+        for line in txt.split("\n"):
+            info, path = line.encode("utf-8").split(b"\t")
+            mode, _, oid = info.split()
+            expected.append((b"M", mode, oid, path[len(flt.prefix) :]))
+        assert sorted(flt.listing(head)) == sorted(expected)
+        flt.close()
+    # a single process per mode, however many lookups
+    commands = [c["cmd"][3:] for c in mono2repo.profiler.phases[-1]["commands"]]
+    assert sorted(commands) == [
+        ["cat-file", "--batch"],
+        ["cat-file", "--batch"],
+        ["cat-file", "--batch-check"],
+        ["cat-file", "--batch-check"],
+    ]
+
+
+def test_fanout(tmp_path, monorepo):
+    # a side branch touching project2 only, merged back
+    monorepo.git("checkout", "-q", "-b", "side")
+    monorepo.commit(
+        "side project2",
+        {"subfolder/project2/side.txt": "side\n"},
+        "2020-02-01T10:00:00",
+    )
+    monorepo.git("checkout", "-q", "master")
+    monorepo.commit(
+        "more project1",
+        {"subfolder/project1/a/more.txt": "more\n"},
+        "2020-02-02T10:00:00",
+    )
+    monorepo.git("commit", "-q", "--allow-empty", "-m", "empty")
+    monorepo.git("merge", "-q", "--no-ff", "-m", "merge side", "side")
+    monorepo.commit("misc", {"misc/more": "last\n"}, "2020-02-03T10:00:00")
+
+    igit = mono2repo.Git(monorepo.path)
+    filtered = mono2repo.fanout(
+        igit,
+        {
+            "subfolder/project1": tmp_path / "project1.git",
+            "subfolder/project2": tmp_path / "project2.git",
+        },
+    )
+
+    def log(git):
+        return git.run(["log", "--format=%s|%P", "--topo-order"]).split("\n")
+
+    project1 = filtered["subfolder/project1"]
+    assert not (project1.gitpath("objects") / "info/alternates").exists()
+    assert project1.run(["ls-tree", "-r", "--name-only", "HEAD"]).split() == [
+        "a/hello.txt",
+        "a/more.txt",
+        "a/subtree",
+    ]
+    # the originally empty commit stays, the merge collapses (side is pruned)
+    assert [line.split("|")[0] for line in log(project1)] == [
+        "empty",
+        "more project1",
+        "update project1",
+        "add project1",
+    ]
+
+    project2 = filtered["subfolder/project2"]
+    assert project2.run(["ls-tree", "-r", "--name-only", "HEAD"]).split() == [
+        "side.txt",
+        "world.txt",
+    ]
+    assert [line.split("|")[0] for line in log(project2)] == [
+        "side project2",
+        "add project2",
+    ]
+    # the original commit data is preserved
+    assert project2.run(["log", "-1", "--format=%an|%ad|%cn|%cd"]) == monorepo.git(
+        "log", "-1", "--format=%an|%ad|%cn|%cd", "side"
+    )
+
+
+@filter_repo
+def test_fanout_parity(tmp_path, monorepo):
+    # a --no-ff merge of a project1 branch (kept), a side branch touching
+    # project2 only merged after a misc change (pruned)
+    monorepo.git("checkout", "-q", "-b", "feature")
+    monorepo.commit(
+        "feature project1",
+        {"subfolder/project1/a/feature.txt": "feature\n"},
+        "2020-02-01T10:00:00",
+    )
+    monorepo.git("checkout", "-q", "master")
+    monorepo.git("merge", "-q", "--no-ff", "-m", "merge feature", "feature")
+    monorepo.git("checkout", "-q", "-b", "side")
+    monorepo.commit(
+        "side project2",
+        {"subfolder/project2/side.txt": "side\n"},
+        "2020-02-02T10:00:00",
+    )
+    monorepo.git("checkout", "-q", "master")
+    monorepo.commit("misc", {"misc/more": "last\n"}, "2020-02-03T10:00:00")
+    monorepo.git("merge", "-q", "--no-ff", "-m", "merge side", "side")
+
+    subdirs = ["subfolder/project1", "subfolder/project2"]
+    filtered = mono2repo.fanout(
+        mono2repo.Git(monorepo.path),
+        {subdir: tmp_path / f"{subdir.split('/')[-1]}.git" for subdir in subdirs},
+    )
+    for subdir in subdirs:
+        upstream = tmp_path / "upstream.git"
+        shutil.rmtree(upstream, ignore_errors=True)
+        monorepo.git("clone", "-q", "--bare", "--no-local", monorepo.path, upstream)
+        expected = mono2repo.filter_subdir(mono2repo.Git(upstream), subdir)
+        log = ["log", "--format=%H %s", "HEAD"]
+        assert filtered[subdir].run(log) == expected.run(log)
+    assert "merge feature" in filtered["subfolder/project1"].run(["log", "-1"])
+
+
+def test_main_native(tmp_path, monorepo):
+    output = tmp_path / "project1"
+    mono2repo.main(
+        [
+            "init",
+            "--backend",
+            "native",
+            "--tmpdir",
+            tmp_path / "tmp",
+            output,
+            monorepo.path / "subfolder/project1",
+        ]
+    )
+    ogit = mono2repo.Git(output)
+    assert ogit.branch == "master"
+    assert ogit.run(["log", "--format=%s", "migrate"]).split("\n") == [
+        "update project1",
+        "add project1",
+        "Initial commit",
+    ]
+
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/new.txt": "new\n"},
+        "2020-02-01T10:00:00",
+    )
+    ogit.run(["merge", "-q", "migrate"])
+    mono2repo.main(["update", "--backend", "native", output])
+    assert ogit.run(["log", "-2", "--format=%s", "migrate"]).split("\n") == [
+        "project1 change",
+        "update project1",
+    ]
+    assert ogit.run(["config", "mono2repo.last"]) == monorepo.git("rev-parse", "HEAD")
+
+    # without the last processed commit update goes through the full history
+    ogit.run(["config", "--unset", "mono2repo.last"])
+    monorepo.commit(
+        "project1 other",
+        {"subfolder/project1/a/other.txt": "other\n"},
+        "2020-02-02T10:00:00",
+    )
+    mono2repo.main(["update", "--backend", "native", output])
+    assert ogit.run(["log", "-3", "--format=%s", "migrate"]).split("\n") == [
+        "project1 other",
+        "project1 change",
+        "update project1",
+    ]
+
+
+@filter_repo
+def test_native_parity(tmp_path, monorepo):
+    # a --no-ff merge whose first parent (a misc change) is pruned: it was
+    # an ancestor of the merged branch already, the merge is kept
+    monorepo.commit("misc", {"misc/more": "misc\n"}, "2020-02-01T10:00:00")
+    monorepo.git("checkout", "-q", "-b", "feature")
+    monorepo.commit(
+        "feature project1",
+        {"subfolder/project1/a/feature.txt": "feature\n"},
+        "2020-02-02T10:00:00",
+    )
+    monorepo.git("checkout", "-q", "master")
+    monorepo.git("merge", "-q", "--no-ff", "-m", "merge feature", "feature")
+
+    log = ["log", "--format=%H %s", "HEAD"]
+    ids = {}
+    for backend in ["native", "filter-repo"]:
+        upstream = tmp_path / f"{backend}.git"
+        monorepo.git("clone", "-q", "--bare", "--no-local", monorepo.path, upstream)
+        igit = mono2repo.Git(upstream)
+        ids[backend] = mono2repo.filter_subdir(igit, "subfolder/project1", backend)
+    assert ids["native"].run(log) == ids["filter-repo"].run(log)
+    assert ids["native"].run(["log", "-1", "--format=%s"]) == "merge feature"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_init_local_shared(tmp_path, monorepo, backend):
+    output = tmp_path / "project1"
+    mono2repo.main(
+        [
+            "init",
+            "--backend",
+            backend,
+            "--profile",
+            tmp_path / "profile.json",
+            output,
+            monorepo.path / "subfolder/project1",
+        ]
+    )
+    commands = [
+        command["cmd"]
+        for phase in json.loads((tmp_path / "profile.json").read_text())["phases"]
+        for command in phase["commands"]
+    ]
+    # the local source objects are borrowed, not copied
+    assert ["--bare", "--shared"] in [cmd[2:4] for cmd in commands if cmd[1] == "clone"]
+
+    # ... and the output doesn't depend on the (gone) temporary clones
+    ogit = mono2repo.Git(output)
+    assert not (ogit.gitpath("objects") / "info/alternates").exists()
+    ogit.run(["fsck", "--no-dangling"])
+    assert ogit.run(["log", "--format=%s", "migrate"]).split("\n") == [
+        "update project1",
+        "add project1",
+        "Initial commit",
+    ]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_sparse(tmp_path, monorepo, backend):
+    output = tmp_path / "project1"
+    uri = monorepo.path / "subfolder/project1"
+    tmpdir = tmp_path / "tmp"
+    args = ["--backend", backend, "--sparse", "--tmpdir", tmpdir]
+    mono2repo.main(["init", *args, output, uri])
+
+    # the upstream clone (left in tmpdir) has only the subdir checked out
+    igit = mono2repo.Git(tmpdir / "legacy-repo")
+    assert igit.config("core.sparseCheckoutCone") == "true"
+    assert igit.config("index.sparse") == "true"
+    assert not (igit.worktree / "misc").exists()
+    if backend == "native":
+        assert igit.run(["sparse-checkout", "list"]) == "subfolder/project1"
+        assert (igit.worktree / "subfolder/project1/a/hello.txt").exists()
+        assert not (igit.worktree / "subfolder/project2").exists()
+        # the out of cone directories are single (tree) index entries
+        assert "misc/" in igit.run(["ls-files", "--sparse"]).split("\n")
+
+    ogit = mono2repo.Git(output)
+    assert ogit.run(["log", "--format=%s", "migrate"]).split("\n") == [
+        "update project1",
+        "add project1",
+        "Initial commit",
+    ]
+
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/new.txt": "new\n"},
+        "2020-02-01T10:00:00",
+    )
+    shutil.rmtree(tmpdir)
+    ogit.run(["merge", "-q", "migrate"])
+    mono2repo.main(["update", *args, output])
+    assert ogit.run(["show", "migrate:a/new.txt"]) == "new"
+
+
+@pytest.mark.parametrize("backend, graft", GRAFTS)
+def test_bounded(tmp_path, monorepo, backend, graft):
+    project1 = "subfolder/project1"
+    monorepo.commit(
+        "project1 change", {f"{project1}/a/hello.txt": "changed\n"}, "2020-02-01"
+    )
+    monorepo.commit("misc change", {"misc/more": "changed\n"}, "2020-02-02")
+    monorepo.commit("project1 more", {f"{project1}/new.txt": "new\n"}, "2020-02-03")
+    # the bounds are on the committer dates
+    monorepo.git("rebase", "-q", "--committer-date-is-author-date", "--root")
+    uri = monorepo.path / project1
+    args = ["--backend", backend, *(["--graft"] if graft else [])]
+
+    def extract(name, *bounds):
+        output = tmp_path / name
+        mono2repo.main(["init", *args, *bounds, output, uri])
+        ogit = mono2repo.Git(output)
+        return ogit, ogit.run(["log", "--format=%s", "migrate"]).split("\n")
+
+    ogit, log = extract("since", "--since", "2020-01-20")
+    assert log[:2] == ["project1 more", "project1 change"]
+    assert log[2].startswith("Initial commit")
+    # the root holds the starting tree, with the starting commit date
+    base = monorepo.git("rev-parse", "HEAD~3")
+    assert ogit.tree(rev="migrate~2") == monorepo.git("rev-parse", f"{base}:{project1}")
+    assert ogit.run(["log", "-1", "--format=%ad", "migrate~2"]) == monorepo.git(
+        "log", "-1", "--format=%cd", base
+    )
+    assert f"before {base}" in ogit.run(["log", "-1", "--format=%b", "migrate~2"])
+    assert ogit.tree(rev="migrate") == monorepo.git("rev-parse", f"HEAD:{project1}")
+    assert mono2repo.commit_map(ogit.worktree, base) == [
+        (base, ogit.run(["rev-parse", "migrate~2"]))
+    ]
+
+    log = extract("max", "--max-commits", "1")[1]
+    assert log[0] == "project1 more" and len(log) == 2
+    assert extract("ref", "--since-ref", "HEAD~1")[1][:1] == ["project1 more"]
+    # the most recent bound wins
+    log = extract("both", "--since", "2020-01-20", "--max-commits", "1")[1]
+    assert len(log) == 2
+    with pytest.raises(SystemExit):
+        extract("invalid", "--since-ref", "no-such-ref")
+
+
+def test_bounded_shallow(tmp_path, monorepo):
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/hello.txt": "changed\n"},
+        "2020-02-01T10:00:00",
+    )
+    monorepo.git("rebase", "-q", "--committer-date-is-author-date", "--root")
+    monorepo.git("tag", "-a", "-m", "release", "v1", "HEAD~1")
+    upstream = tmp_path / "monorepo.git"
+    monorepo.git("clone", "-q", "--bare", monorepo.path, upstream)
+    uri = f"file://{upstream}/subfolder/project1"
+
+    def extract(name, *bounds):
+        output, tmpdir = tmp_path / name, tmp_path / f"{name}-tmp"
+        mono2repo.main(
+            ["init", "--backend", "native", "--tmpdir", tmpdir, *bounds, output, uri]
+        )
+        ogit = mono2repo.Git(output)
+        assert ogit.run(["log", "--format=%s", "migrate"]).split("\n") == [
+            "project1 change",
+            "Initial commit",
+        ]
+        return mono2repo.Git(tmpdir / "legacy-repo")
+
+    # the older history is not downloaded: only the starting commit
+    for bounds in [["--since", "2020-01-20"], ["--since-ref", "v1"]]:
+        igit = extract(bounds[0].strip("-"), *bounds)
+        assert igit.run(["rev-parse", "--is-shallow-repository"]) == "true"
+        assert igit.run(["log", "--format=%s", "HEAD"]).split("\n") == [
+            "project1 change",
+            "update project1",
+        ]
+    # a commit can't be excluded by id: the whole history is cloned
+    igit = extract("sha", "--since-ref", monorepo.git("rev-parse", "HEAD~1"))
+    assert igit.run(["rev-parse", "--is-shallow-repository"]) == "false"
+    with pytest.raises(SystemExit):
+        extract("invalid", "--since-ref", "no-such-ref")
+
+
+@pytest.mark.parametrize("backend, graft", GRAFTS)
+def test_refs(tmp_path, monorepo, backend, graft):
+    project1 = "subfolder/project1"
+    monorepo.git("tag", "v0.1", "HEAD~3")
+    monorepo.git("tag", "-a", "-m", "release 1.0", "v1.0", "HEAD")
+    monorepo.git("checkout", "-q", "-b", "release/1.x")
+    monorepo.commit("fix project1", {f"{project1}/fix.txt": "fix\n"}, "2020-02-01")
+    monorepo.commit("release misc", {"misc/more": "release\n"}, "2020-02-02")
+    # forking from a commit not touching project1
+    monorepo.git("checkout", "-q", "-b", "feature", "master~1")
+    monorepo.commit("feature", {f"{project1}/feature.txt": "x\n"}, "2020-02-03")
+    monorepo.git("checkout", "-q", "-b", "other", "master")
+    monorepo.commit("other", {f"{project1}/other.txt": "x\n"}, "2020-02-04")
+    monorepo.git("checkout", "-q", "master")
+    monorepo.commit("project1 more", {f"{project1}/more.txt": "x\n"}, "2020-02-05")
+
+    output = tmp_path / "project1"
+    args = ["--backend", backend, *(["--graft"] if graft else [])]
+    refs = ["--refs", "release/*", "--refs", "v*", "--refs", "feature"]
+    mono2repo.main(["init", *args, *refs, "-j", "2", output, monorepo.path / project1])
+    ogit = mono2repo.Git(output)
+
+    def subjects(ref):
+        return ogit.run(["log", "--format=%s", ref]).split("\n")
+
+    refs = ogit.run(["for-each-ref", "--format=%(refname)"]).split()
+    assert set(refs) == {
+        "refs/heads/master",
+        "refs/heads/migrate",
+        "refs/heads/release/1.x",
+        "refs/heads/feature",
+        "refs/tags/v0.1",
+        "refs/tags/v1.0",
+    }
+    # the history shared with migrate is reused
+    assert subjects("migrate")[1:] == subjects("release/1.x")[1:]
+    assert subjects("release/1.x")[0] == "fix project1"
+    assert ogit.run(["rev-parse", "release/1.x~1"]) == ogit.run(
+        ["rev-parse", "migrate~1"]
+    )
+    assert ogit.run(["rev-parse", "feature~1"]) == ogit.run(["rev-parse", "migrate~2"])
+    assert ogit.run(["rev-parse", "v0.1"]) == ogit.run(["rev-parse", "migrate~2"])
+    assert ogit.run(["cat-file", "-t", "v1.0"]) == "tag"
+    assert ogit.run(["rev-parse", "v1.0^{commit}"]) == ogit.run(
+        ["rev-parse", "migrate~1"]
+    )
+    assert "release 1.0" in ogit.run(["cat-file", "tag", "v1.0"])
+    assert ogit.tree(rev="release/1.x") == monorepo.git(
+        "rev-parse", f"release/1.x:{project1}"
+    )
+    fix = monorepo.git("rev-parse", "release/1.x~1")
+    assert mono2repo.commit_map(output, fix) == [
+        (fix, ogit.run(["rev-parse", "release/1.x"]))
+    ]
+    assert ogit.run(["config", "mono2repo.refs"]) == "release/* v* feature"
+
+    # update follows the init refs
+    monorepo.git("checkout", "-q", "release/1.x")
+    monorepo.commit("fix more", {f"{project1}/fix.txt": "more\n"}, "2020-02-06")
+    monorepo.git("checkout", "-q", "master")
+    ogit.run(["merge", "-q", "migrate"])
+    mono2repo.main(["update", *args, output])
+    assert subjects("release/1.x")[:2] == ["fix more", "fix project1"]
+    assert ogit.run(["merge-base", "--is-ancestor", "release/1.x~2", "migrate"]) == ""
+
+    # full history update
+    ogit.run(["config", "--unset", "mono2repo.last"])
+    mono2repo.main(["update", *args, output])
+    assert subjects("release/1.x")[:2] == ["fix more", "fix project1"]
+    assert ogit.run(["merge-base", "--is-ancestor", "release/1.x~2", "migrate"]) == ""
+
+
+@pytest.mark.parametrize("backend, graft", GRAFTS)
+def test_refs_bounded(tmp_path, monorepo, backend, graft):
+    project1 = "subfolder/project1"
+    monorepo.commit("a 1", {f"{project1}/a.txt": "1\n"}, "2020-02-01")
+    # a branch forking before the bound
+    monorepo.git("checkout", "-q", "-b", "release/1")
+    monorepo.commit("release", {f"{project1}/r.txt": "r\n"}, "2020-02-02")
+    monorepo.git("checkout", "-q", "master")
+    monorepo.commit("a 2", {f"{project1}/a.txt": "2\n"}, "2020-02-03")
+    monorepo.commit("more", {f"{project1}/more.txt": "x\n"}, "2020-02-04")
+
+    output = tmp_path / "project1"
+    args = ["--backend", backend, *(["--graft"] if graft else [])]
+    bounds = ["--max-commits", "1", "--refs", "release/*"]
+    mono2repo.main(["init", *args, *bounds, output, monorepo.path / project1])
+    ogit = mono2repo.Git(output)
+    assert ogit.run(["log", "--format=%s", "migrate"]).split("\n")[0] == "more"
+    # the branch has its own tree, on top of the initial commit
+    assert ogit.tree(rev="release/1") == monorepo.git(
+        "rev-parse", f"release/1:{project1}"
+    )
+    assert ogit.run(["log", "--format=%s", "release/1"]).split("\n")[0] == "release"
+    assert ogit.run(["show", "release/1:a.txt"]) == "1"
+
+
+def test_finalize(tmp_path, monorepo, caplog):
+    caplog.set_level("INFO")
+    output = tmp_path / "project1"
+    uri = monorepo.path / "subfolder/project1"
+    mono2repo.main(["init", "--backend", "native", "--finalize", output, uri])
+    ogit = mono2repo.Git(output)
+
+    def check():
+        pack = ogit.gitpath("objects/pack")
+        assert (pack / "multi-pack-index").exists()
+        assert list(pack.glob("*.bitmap"))
+        assert ogit.gitpath("objects/info/commit-graph").exists()
+        counts = ogit.run(["count-objects", "-v"]).split("\n")
+        counts = dict(line.split(": ") for line in counts)
+        # only the reachable objects are left, in a single pack
+        reachable = ogit.run(["rev-list", "--objects", "--all"]).split("\n")
+        assert (counts["count"], counts["packs"]) == ("0", "1")
+        assert int(counts["in-pack"]) == len(reachable)
+
+    check()
+    assert "finalized" in caplog.text
+
+    # the rebased away commits are pruned
+    monorepo.commit(
+        "project1 change", {"subfolder/project1/a/new.txt": "new\n"}, "2020-02-01"
+    )
+    ogit.run(["commit", "--allow-empty", "-q", "-m", "downstream"])
+    rebased = ogit.run(["rev-parse", "migrate"])
+    mono2repo.main(["update", "--backend", "native", "--finalize", output])
+    check()
+    assert not ogit.run(["cat-file", "-e", rebased], abort=False, silent=True)
+
+
+def test_store(tmp_path, monorepo):
+    store = tmp_path / "store.git"
+    sgit = mono2repo.Git(store)
+
+    def extract(name, project, *args):
+        output = tmp_path / name
+        uri = monorepo.path / "subfolder" / project
+        mono2repo.main(["init", "--backend", "native", *args, output, uri])
+        return mono2repo.Git(output)
+
+    def local(git):
+        counts = git.run(["count-objects", "-v"]).split("\n")
+        counts = dict(line.split(": ") for line in counts)
+        return int(counts["count"]) + int(counts["in-pack"])
+
+    def namespaces():
+        refs = sgit.run(["for-each-ref", "--format=%(refname)", "refs/mono2repo"])
+        return {ref.split("/")[2] for ref in refs.split()}
+
+    ogits = [extract("project1", "project1", "--store", store)]
+    ogits.append(extract("project2", "project2"))
+    ogits.append(extract("grafted", "project1", "--store", store, "--graft"))
+    for ogit in ogits:
+        assert ogit.run(["fsck", "--connectivity-only", "--no-dangling"]) == ""
+    # the shared outputs keep no objects of their own
+    assert local(ogits[1]) and not local(ogits[0]) and not local(ogits[2])
+    assert ogits[0].gitpath("objects/info/alternates").read_text() == (
+        f"{sgit.gitpath('objects')}\n"
+    )
+    store1 = mono2repo.ObjectStore(store)
+    assert namespaces() == {store1.key(ogits[0]), store1.key(ogits[2])}
+
+    # new downstream objects are moved in the store
+    (ogits[0].worktree / "new.txt").write_text("new\n")
+    ogits[0].run(["add", "new.txt"])
+    ogits[0].run(["commit", "-q", "-m", "downstream"])
+    assert local(ogits[0])
+    shutil.rmtree(ogits[2].worktree)
+    assert mono2repo.main(["maintain", "--prune", "now", store]) == 0
+    assert not local(ogits[0])
+    assert namespaces() == {store1.key(ogits[0])}
+    assert list(store1.outputs().values()) == [ogits[0].worktree]
+    # the gc keeps every object the outputs need
+    assert ogits[0].run(["fsck", "--connectivity-only", "--no-dangling"]) == ""
+    assert ogits[0].run(["log", "--format=%s", "master"]).split("\n")[0] == (
+        "downstream"
+    )
+    assert ogits[0].run(["gc", "-q"]) == ""
+    assert ogits[0].run(["fsck", "--connectivity-only", "--no-dangling"]) == ""
+
+    # an output no longer borrowing from the store is detached
+    ogits[0].run(["repack", "-a", "-d", "-q"])
+    ogits[0].gitpath("objects/info/alternates").unlink()
+    assert mono2repo.main(["maintain", "--prune", "now", store]) == 0
+    assert not namespaces() and not store1.outputs()
+    assert ogits[0].run(["fsck", "--connectivity-only", "--no-dangling"]) == ""
+
+    with pytest.raises(SystemExit):
+        mono2repo.main(["maintain", tmp_path / "missing"])
+
+
+def test_blobless(tmp_path, monorepo):
+    # an older blob, not checked out
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/hello.txt": "changed\n"},
+        "2020-02-01T10:00:00",
+    )
+    upstream = tmp_path / "monorepo.git"
+    monorepo.git("clone", "-q", "--bare", monorepo.path, upstream)
+    mono2repo.Git(upstream).run(["config", "uploadpack.allowFilter", "true"])
+    mono2repo.Git(upstream).run(["config", "uploadpack.allowAnySHA1InWant", "true"])
+    uri = f"file://{upstream}/subfolder/project1"
+
+    igit = mono2repo.Git.clone(
+        mono2repo.split_source(uri)[0], tmp_path / "partial", bare=True, blobless=True
+    )
+    assert igit.tree("subfolder/project1")
+    assert not igit.tree("subfolder/project3")
+
+    def missing():
+        objects = igit.run(["rev-list", "--objects", "--missing=print", "--all"])
+        return {line[1:] for line in objects.split() if line.startswith("?")}
+
+    def blobs(path):
+        txt = monorepo.git("log", "--format=", "--raw", "--no-abbrev", "--", path)
+        return set(txt.split()[3::6])
+
+    assert blobs("subfolder/project1") & missing()
+    assert mono2repo.prefetch(igit, ["subfolder/project1"]) == len(
+        blobs("subfolder/project1")
+    )
+    assert not blobs("subfolder/project1") & missing()
+    assert blobs("subfolder/project2") <= missing()
+
+    output = tmp_path / "project1"
+    mono2repo.main(["init", "--blobless", "--backend", "native", output, uri])
+    assert mono2repo.Git(output).run(["log", "--format=%s", "migrate"]).split(
+        "\n"
+    ) == ["project1 change", "update project1", "add project1", "Initial commit"]
+
+    # the incremental update fetches the new blobs only
+    monorepo.commit(
+        "project1 again",
+        {"subfolder/project1/a/hello.txt": "again\n"},
+        "2020-02-02T10:00:00",
+    )
+    monorepo.git("push", "-q", upstream, "master")
+    mono2repo.main(["update", "--blobless", "--backend", "native", output])
+    assert mono2repo.Git(output).run(["show", "migrate:a/hello.txt"]) == "again"
+
+
+def test_update_graft(tmp_path, monorepo):
+    output = tmp_path / "project1"
+    uri = monorepo.path / "subfolder/project1"
+    mono2repo.main(["init", "--backend", "native", "--graft", output, uri])
+    ogit = mono2repo.Git(output)
+
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/hello.txt": "changed\n", "misc/more": "more\n"},
+        "2020-02-01T10:00:00",
+    )
+    monorepo.commit("misc only", {"misc/more": "again\n"}, "2020-02-02T10:00:00")
+    mono2repo.main(["update", "--graft", "--backend", "native", output])
+    assert ogit.branch == "master"
+    assert ogit.run(["log", "-2", "--format=%s|%aI|%cI", "migrate"]).split("\n") == [
+        "project1 change|2020-02-01T10:00:00+00:00|2020-02-01T10:00:00+00:00",
+        "update project1|2020-01-05T10:00:00+00:00|2020-01-05T10:00:00+00:00",
+    ]
+    assert ogit.tree(rev="migrate") == monorepo.git(
+        "rev-parse", "HEAD:subfolder/project1"
+    )
+
+    # the checked out migrate branch is kept in sync
+    ogit.run(["checkout", "-q", "migrate"])
+    monorepo.commit(
+        "project1 new", {"subfolder/project1/new.txt": "new\n"}, "2020-02-03T10:00:00"
+    )
+    mono2repo.main(["update", "--graft", "--backend", "native", output])
+    assert ogit.run(["status", "--porcelain"]) == ""
+    assert (output / "new.txt").read_text() == "new\n"
+
+
+def test_plan(tmp_path, monorepo, capsys):
+    output = tmp_path / "project1"
+    uri = monorepo.path / "subfolder/project1"
+    pathspec = ["--", "subfolder/project1"]
+    before = sorted(os.listdir(monorepo.path / ".git"))
+
+    result = mono2repo.plan(output, str(uri), backend="native", graft=True)
+    assert not output.exists()
+    assert sorted(os.listdir(monorepo.path / ".git")) == before
+    assert result["action"] == "init"
+    assert result["commits"] == int(monorepo.git("rev-list", "--count", "HEAD"))
+    assert result["extracted"] == int(
+        monorepo.git("rev-list", "--count", "HEAD", *pathspec)
+    )
+    assert result["merges"] == 0
+    blobs = ["hello world", "subtree\n", "hello\n"]
+    assert result["subdir_size"] >= sum(len(b) for b in blobs)
+    assert set(result["phases"]) == {"clone", "graft"}
+    assert result["commands"][0][:4] == ["git", "clone", "--bare", "--shared"]
+    # filtered and grafted in a single pass
+    (graft,) = [cmd for cmd in result["commands"] if "|" in cmd]
+    n = graft.index("|")
+    assert graft[n - 2 : n] == pathspec
+    assert graft[n + 1 :][2:4] == [str(output.resolve()), "fast-import"]
+
+    # the update plan starts from the last extracted upstream commit
+    mono2repo.main(["init", "--backend", "native", output, uri])
+    monorepo.commit(
+        "project1 change",
+        {"subfolder/project1/a/new.txt": "new\n", "misc/more": "more\n"},
+        "2020-02-01T10:00:00",
+    )
+    monorepo.commit("misc only", {"misc/more": "again\n"}, "2020-02-02T10:00:00")
+    head = mono2repo.Git(output).run(["rev-parse", "master"])
+    mono2repo.main(["plan", "--backend", "native", output])
+    txt = capsys.readouterr().out
+    assert "commits   1 to rewrite (0 merges) out of 2" in txt
+    assert "format-patch" in txt and "estimate  clone 0.0s, replay" in txt
+    assert mono2repo.Git(output).run(["rev-parse", "master"]) == head
+
+    pytest.raises(SystemExit, mono2repo.main, ["plan", output, uri])
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_filter_cache(tmp_path, monorepo, backend):
+    filters = tmp_path / "filters"
+    uri = monorepo.path / "subfolder/project1"
+    head = monorepo.git("rev-parse", "HEAD")
+
+    def init(name):
+        profile = tmp_path / f"{name}.json"
+        mono2repo.main(
+            [
+                "init",
+                "--backend",
+                backend,
+                "--filter-cache",
+                filters,
+                "--profile",
+                profile,
+                tmp_path / name,
+                uri,
+            ]
+        )
+        ogit = mono2repo.Git(tmp_path / name)
+        assert ogit.run(["config", "mono2repo.last"]) == head
+        assert ogit.run(["log", "--format=%s", "migrate"]).split("\n") == [
+            "update project1",
+            "add project1",
+            "Initial commit",
+        ]
+        phases = json.loads(profile.read_text())["phases"]
+        return {phase["name"] for phase in phases}
+
+    assert {"lookup", "clone", "filter", "store"} <= init("first")
+    cache = mono2repo.FilterCache(filters)
+    [(bundle, _, _)] = cache.entries()
+    assert bundle.stem == cache.key(head, "subfolder/project1", backend)
+
+    # the second run doesn't clone nor filter the upstream
+    phases = init("second")
+    assert "lookup" in phases
+    assert not {"clone", "filter", "store"} & phases
+
+    # a corrupted entry is dropped and built again
+    bundle.write_bytes(bundle.read_bytes()[:-10])
+    assert {"clone", "filter", "store"} <= init("third")
+    assert cache.get(bundle.stem, tmp_path / "check.git")
+
+    # eviction by age
+    os.utime(bundle, (0, 0))
+    assert mono2repo.FilterCache(filters, maxage=3600).evict() == [bundle]
+    assert not list(filters.iterdir())
+
+    # the bounded histories need the upstream one
+    args = ["init", "--filter-cache", filters, "--max-commits", "1"]
+    pytest.raises(SystemExit, mono2repo.main, [*args, tmp_path / "bounded", uri])
+
+
+def test_commit_map_lookup(tmp_path):
+    cmap = mono2repo.CommitMap(tmp_path / "commit-map")
+    assert cmap.lookup("ab") == []
+    pairs = {f"{n:02x}" * 20: f"{n:02x}" * 19 + "ff" for n in range(0, 250, 5)}
+    cmap.update(pairs)
+    assert cmap.items() == pairs
+    assert cmap.lookup("05" * 20) == [("05" * 20, "05" * 19 + "ff")]
+    assert cmap.lookup("05" * 19 + "FF") == [("05" * 20, "05" * 19 + "ff")]
+    assert cmap.lookup("0") == [
+        (up, ext) for up, ext in sorted(pairs.items()) if up[0] == "0"
+    ]
+    assert cmap.lookup("0e") == []
+
+    # the rewritten extracted commits are followed
+    cmap.update({"01" * 20: "02" * 20}, {"05" * 19 + "ff": "fe" * 20})
+    assert cmap.lookup("05") == [("05" * 20, "fe" * 20)]
+    assert cmap.lookup("fe") == [("05" * 20, "fe" * 20)]
+    assert cmap.lookup("01") == [("01" * 20, "02" * 20)]
+
+
+@pytest.mark.parametrize("backend, graft", GRAFTS)
+def test_commit_map(tmp_path, monorepo, capsys, backend, graft):
+    output = tmp_path / "project1"
+    ogit = mono2repo.Git(output)
+    args = ["--backend", backend, *(["--graft"] if graft else [])]
+
+    def check():
+        cmap = mono2repo.CommitMap.of(ogit).items()
+        upstream = monorepo.git("log", "--format=%H", "--", "subfolder/project1")
+        assert set(cmap) == set(upstream.split())
+        for up, ext in cmap.items():
+            assert ogit.run(["merge-base", "--is-ancestor", ext, "migrate"]) == ""
+            assert ogit.tree(rev=ext) == monorepo.git(
+                "rev-parse", f"{up}:subfolder/project1"
+            )
+            assert ogit.run(["log", "-1", "--format=%s", ext]) == monorepo.git(
+                "log", "-1", "--format=%s", up
+            )
+        return cmap
+
+    mono2repo.main(["init", *args, output, monorepo.path / "subfolder/project1"])
+    check()
+
+    # incremental update
+    monorepo.commit(
+        "project1 change", {"subfolder/project1/a/new.txt": "new\n"}, "2020-02-01"
+    )
+    ogit.run(["merge", "-q", "migrate"])
+    mono2repo.main(["update", *args, output])
+    cmap = check()
+
+    head = monorepo.git("rev-parse", "HEAD")
+    assert mono2repo.main(["map", "-C", output, head[:10]]) == 0
+    assert capsys.readouterr().out == f"{head} {cmap[head]}\n"
+    assert mono2repo.main(["map", "-C", output, cmap[head]]) == 0
+    assert capsys.readouterr().out == f"{head} {cmap[head]}\n"
+
+    # full history update
+    ogit.run(["config", "--unset", "mono2repo.last"])
+    monorepo.commit(
+        "project1 other", {"subfolder/project1/a/other.txt": "x\n"}, "2020-02-02"
+    )
+    mono2repo.main(["update", *args, output])
+    check()
+
+
+def test_update_all(tmp_path, monorepo):
+    outputs = tmp_path / "outputs"
+    for name in ["project1", "project2"]:
+        mono2repo.main(
+            [
+                "init",
+                "--backend",
+                "native",
+                outputs / "group" / name,
+                monorepo.path / "subfolder" / name,
+            ]
+        )
+    broken = mono2repo.Git(outputs / "broken")
+    broken.init()
+    broken.run(["config", "mono2repo.uri", tmp_path / "missing"])
+    # not an extracted repo
+    mono2repo.Git(outputs / "other").init()
+
+    assert mono2repo.discover([outputs]) == {
+        outputs / "broken": str(tmp_path / "missing"),
+        outputs / "group/project1": str(monorepo.path / "subfolder/project1"),
+        outputs / "group/project2": str(monorepo.path / "subfolder/project2"),
+    }
+
+    monorepo.commit(
+        "both change",
+        {
+            "subfolder/project1/a/new.txt": "new\n",
+            "subfolder/project2/new.txt": "new\n",
+        },
+        "2020-02-01T10:00:00",
+    )
+    cache = tmp_path / "cache"
+    args = ["update-all", "--backend", "native", "--cache", cache, "-j", "2"]
+    assert mono2repo.main([*args, "--per-source", "1", outputs]) == 1
+
+    for name in ["project1", "project2"]:
+        ogit = mono2repo.Git(outputs / "group" / name)
+        assert ogit.run(["log", "-1", "--format=%s", "migrate"]) == "both change"
+    # a single mirror shared by both the outputs
+    assert len(list(cache.glob("*.git"))) == 1
+
+    shutil.rmtree(outputs / "broken")
+    assert mono2repo.main([*args, outputs]) == 0
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_init_graft(tmp_path, monorepo, backend):
+
+    def extract(path, **kwargs):
+        igit = mono2repo.Git.clone(monorepo.path, path / "legacy-repo")
+        ogit = mono2repo.Git(path / "output")
+        mono2repo.init(igit, ogit, "subfolder/project1", "migrate", **kwargs)
+        return ogit
+
+    rebased = extract(tmp_path / "rebase", backend=backend)
+    grafted = extract(tmp_path / "graft", backend=backend, graft=True)
+
+    # the initial commits are dated now, compare the extracted ones
+    fmt = "--format=%T|%an|%ae|%ad|%cn|%ce|%cd|%s"
+    assert grafted.run(["log", fmt, "master..migrate"]) == rebased.run(
+        ["log", fmt, "master..migrate"]
+    )
+    assert grafted.branch == "master"
+    assert not grafted.run(["status", "--porcelain"])
+
+
+def test_profile(tmp_path, monorepo, monkeypatch):
+    # the dates below are read by git (not in-process by a library)
+    monkeypatch.setattr(mono2repo.Git, "READER", "cli")
+    output = tmp_path / "project1"
+    report = tmp_path / "profile.json"
+    mono2repo.main(
+        [
+            "init",
+            "--backend",
+            "native",
+            "--profile",
+            report,
+            output,
+            monorepo.path / "subfolder/project1",
+        ]
+    )
+    data = json.loads(report.read_text())
+    phases = {phase["name"]: phase for phase in data["phases"]}
+    assert {"prepare", "clone", "filter", "dates", "fetch", "rebase"} <= set(phases)
+    assert data["wall"] >= sum(p["wall"] for p in data["phases"] if not p["parent"])
+
+    (clone,) = phases["clone"]["commands"]
+    assert clone["cmd"][:2] == ["git", "clone"]
+    assert clone["code"] == 0
+    assert any(c["cmd"][3] == "fast-export" for c in phases["filter"]["commands"])
+    assert phases["dates"]["commands"][0]["bytes"] > 0